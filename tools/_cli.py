@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# @Author: Kelvin
+# @Date:   2026-10-19 12:05:48
+# @Last Modified by:   Kelvin
+# @Last Modified time: 2026-10-19 12:05:48
+"""Command line interface."""
+import argparse
+import h5py
+import os
+
+from typing import Dict, List, Optional
+
+try:
+    from anndata.io import read_elem
+except ImportError:
+    from anndata.experimental import read_elem
+
+from .sc._sc import _DEres_arrays, _DEres_frame
+
+
+def read_de(filename: str, key: str = "rank_genes_groups") -> Dict:
+    """
+    Read only the DE results from a `.h5ad` file.
+
+    Nothing else in the file is loaded, so `.X` can be any size.
+
+    Parameters
+    ----------
+    filename : str
+        path to `.h5ad` file.
+    key : str, optional
+        name in `.uns` to retrieve DE results.
+
+    Returns
+    -------
+    Dict
+        DE results, as they would be in `adata.uns[key]`.
+    """
+    with h5py.File(filename, "r") as f:
+        if "uns" not in f or key not in f["uns"]:
+            raise KeyError("`uns/{}` not found in {}.".format(key, filename))
+        return read_elem(f["uns"][key])
+
+
+def export_de(
+    filename: str,
+    output: str,
+    columns: Optional[List[str]] = None,
+    remove_mito_ribo: bool = True,
+    key: str = "rank_genes_groups",
+    all_columns: bool = False,
+) -> List[str]:
+    """
+    Export DE results from a `.h5ad` file without loading the `AnnData` object.
+
+    Parameters
+    ----------
+    filename : str
+        path to `.h5ad` file.
+    output : str
+        output file if a single contrast is exported. Otherwise, a directory
+        where one `<contrast>.tsv` file per contrast is written.
+    columns : Optional[List[str]], optional
+        contrasts to export. Only the first contrast if None.
+    remove_mito_ribo : bool, optional
+        whether to filter all mito and ribo genes in the output.
+    key : str, optional
+        name in `.uns` to retrieve DE results.
+    all_columns : bool, optional
+        whether to export all contrasts, ignoring `columns`.
+
+    Returns
+    -------
+    List[str]
+        List of files written.
+    """
+    de = read_de(filename, key=key)
+    if all_columns:
+        columns = list(de["scores"].dtype.fields.keys())
+    elif columns is None:
+        columns = list(de["scores"].dtype.fields.keys())[:1]
+    if len(columns) == 1 and not all_columns:
+        outfiles = [output]
+    else:
+        os.makedirs(output, exist_ok=True)
+        outfiles = [
+            os.path.join(output, column.replace(os.sep, "_") + ".tsv")
+            for column in columns
+        ]
+    for column, outfile in zip(columns, outfiles):
+        arrays, keep = _DEres_arrays(de, column, remove_mito_ribo=remove_mito_ribo)
+        _DEres_frame(arrays, keep).to_csv(outfile, sep="\t")
+    return outfiles
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Run the `kttools` command line interface.
+
+    Parameters
+    ----------
+    argv : Optional[List[str]], optional
+        command line arguments. `sys.argv` if None.
+
+    Returns
+    -------
+    int
+        exit code.
+    """
+    parser = argparse.ArgumentParser(
+        prog="kttools", description="Kelvin's miscellaneous tools."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    de_parser = subparsers.add_parser(
+        "export-de",
+        help="export DE results from a .h5ad file.",
+        description="Export `sc.tl.rank_genes_groups` results from a .h5ad file, "
+        "reading only `uns/<key>` from disk.",
+    )
+    de_parser.add_argument("h5ad", help="input .h5ad file.")
+    de_parser.add_argument(
+        "-o",
+        "--output",
+        required=True,
+        help="output .tsv file, or a directory if several contrasts are exported.",
+    )
+    de_parser.add_argument(
+        "-c",
+        "--column",
+        action="append",
+        dest="columns",
+        help="contrast to export. Can be repeated. Defaults to the first contrast.",
+    )
+    de_parser.add_argument(
+        "--all",
+        action="store_true",
+        help="export all contrasts into the output directory.",
+    )
+    de_parser.add_argument(
+        "-k",
+        "--key",
+        default="rank_genes_groups",
+        help="name in `.uns` to retrieve DE results.",
+    )
+    de_parser.add_argument(
+        "--keep-mito-ribo",
+        action="store_true",
+        help="keep mito and ribo genes in the output.",
+    )
+
+    args = parser.parse_args(argv)
+    if args.command == "export-de":
+        for outfile in export_de(
+            args.h5ad,
+            args.output,
+            columns=args.columns,
+            remove_mito_ribo=not args.keep_mito_ribo,
+            key=args.key,
+            all_columns=args.all,
+        ):
+            print(outfile)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -5,23 +5,45 @@
 # @Last Modified time: 2022-07-18 12:00:49
 """single cell module."""
 
+from ._aggregate import aggregate, group_indicator, pseudobulk
+from ._cache import clear_cache
+from ._csc import clear_csc, get_csc
+from ._destore import DEStore
+from ._pipeline import run_pipeline
+from ._shared import SharedPool, shared_adata
 from ._sc import (
     exportDEres,
     returnDEres,
+    viewDEres,
     vmax,
     vmin,
     cell_cycle_scoring,
+    combine_categories,
     combine_two_categories,
     dotplot_2obs,
+    dotplot_2obs_batch,
 )
 
 __all__ = [
     # single-cell
     "exportDEres",
     "returnDEres",
+    "viewDEres",
     "vmax",
     "vmin",
     "cell_cycle_scoring",
+    "combine_categories",
     "combine_two_categories",
     "dotplot_2obs",
+    "dotplot_2obs_batch",
+    "aggregate",
+    "group_indicator",
+    "pseudobulk",
+    "clear_cache",
+    "clear_csc",
+    "get_csc",
+    "DEStore",
+    "run_pipeline",
+    "SharedPool",
+    "shared_adata",
 ]
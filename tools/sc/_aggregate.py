@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+# @Author: Kelvin
+# @Date:   2026-10-19 10:02:11
+# @Last Modified by:   Kelvin
+# @Last Modified time: 2026-10-19 10:02:11
+"""Sparse group aggregation of expression values over `.obs` keys."""
+import scipy.sparse
+
+import numpy as np
+import pandas as pd
+
+from anndata import AnnData
+from pandas import DataFrame, Index
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from ._csc import csc_view
+from ._kernels import group_stats
+from ._utils import _dense, _get_matrix, _is_dask
+
+
+def _packed_codes(obs: DataFrame, keys: List[str]) -> Tuple[np.ndarray, List[Index]]:
+    """
+    Pack the categorical codes of several `.obs` columns into one code per cell.
+
+    The codes are combined with mixed-radix arithmetic one column at a time and
+    re-compacted to the observed combinations after every step, so the packed
+    code never overflows and the work stays linear in the number of cells.
+
+    Parameters
+    ----------
+    obs : DataFrame
+        `.obs` of an `AnnData` object.
+    keys : List[str]
+        column names to combine, in order.
+
+    Returns
+    -------
+    Tuple[np.ndarray, List[Index]]
+        the packed code for each cell (-1 if any of the columns is missing) and,
+        for each column, the category of every observed combination. Observed
+        combinations are sorted lexicographically by the category order of `keys`.
+    """
+    n = obs.shape[0]
+    codes = np.zeros(n, dtype=np.int64)
+    valid = np.ones(n, dtype=bool)
+    combos = np.zeros((1, 0), dtype=np.int64)
+    categories = []
+    for key in keys:
+        cat = obs[key].astype("category")
+        c = cat.cat.codes.to_numpy().astype(np.int64)
+        n_c = len(cat.cat.categories)
+        categories.append(cat.cat.categories)
+        valid &= c >= 0
+        packed = codes * n_c + c
+        radix = combos.shape[0] * n_c
+        if radix <= max(4 * n, 1 << 16):
+            present = np.flatnonzero(np.bincount(packed[valid], minlength=radix))
+            remap = np.full(radix, -1, dtype=np.int64)
+            remap[present] = np.arange(len(present))
+            codes[valid] = remap[packed[valid]]
+        else:
+            present, codes[valid] = np.unique(packed[valid], return_inverse=True)
+        combos = np.column_stack([combos[present // n_c], present % n_c])
+    codes[~valid] = -1
+    return codes, [cats[combos[:, i]] for i, cats in enumerate(categories)]
+
+
+def _group_index(levels: List[Index], keys: List[str]) -> Index:
+    """
+    Label observed combinations with an `Index`, or a `MultiIndex` for several keys.
+
+    Parameters
+    ----------
+    levels : List[Index]
+        category of every observed combination, for each key.
+    keys : List[str]
+        names of the keys.
+
+    Returns
+    -------
+    Index
+        group labels.
+    """
+    if len(keys) == 1:
+        return pd.Index(levels[0], name=keys[0])
+    return pd.MultiIndex.from_arrays(levels, names=keys)
+
+
+def group_indicator(
+    adata: AnnData, keys: Union[List[str], str]
+) -> Tuple[scipy.sparse.csr_matrix, Index]:
+    """
+    Build a sparse one-hot group-indicator matrix from one or more `.obs` keys.
+
+    Groups are the observed combinations of the categories of `keys`. Cells
+    with a missing value in any of the keys do not belong to any group.
+
+    Parameters
+    ----------
+    adata : AnnData
+        input `AnnData` object.
+    keys : Union[List[str], str]
+        column(s) in `.obs` to group by.
+
+    Returns
+    -------
+    Tuple[scipy.sparse.csr_matrix, Index]
+        `n_groups` x `n_obs` indicator matrix and the group labels.
+    """
+    if type(keys) is not list:
+        keys = [keys]
+    codes, levels = _packed_codes(adata.obs, keys)
+    keep = codes >= 0
+    indicator = scipy.sparse.csr_matrix(
+        (
+            np.ones(keep.sum(), dtype=np.float64),
+            (codes[keep], np.flatnonzero(keep)),
+        ),
+        shape=(len(levels[0]), adata.n_obs),
+    )
+    return indicator, _group_index(levels, keys)
+
+
+def _iter_chunks(
+    X, gene_idx: Optional[np.ndarray], chunk_size: Optional[int], csc: bool = False
+):
+    """
+    Yield row chunks of `X` restricted to `gene_idx`.
+
+    Parameters
+    ----------
+    X
+        in-memory or backed matrix.
+    gene_idx : Optional[np.ndarray]
+        column positions to keep. All columns if None.
+    chunk_size : Optional[int]
+        number of rows per chunk. All rows at once if None, or the row
+        chunks of a dask array.
+    csc : bool, optional
+        whether a whole in-memory sparse matrix is read from its cached CSC
+        companion (see `get_csc`). Always the case if `gene_idx` is given.
+
+    Yields
+    ------
+    Tuple[int, int, Union[scipy.sparse.spmatrix, np.ndarray]]
+        start row, end row and the chunk.
+    """
+    if _is_dask(X):
+        # only the selected columns are computed, one block of rows at a time
+        if gene_idx is not None:
+            X = X[:, gene_idx]
+        X = X.rechunk({1: -1} if chunk_size is None else {0: chunk_size, 1: -1})
+        bounds = np.cumsum((0,) + X.chunks[0])
+        for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            chunk = X.blocks[i, 0].compute()
+            if scipy.sparse.issparse(chunk):
+                chunk = scipy.sparse.csr_matrix(chunk)
+            else:
+                chunk = np.asarray(chunk)
+            yield int(start), int(end), chunk
+        return
+    n = X.shape[0]
+    if chunk_size is None:
+        chunk_size = n
+    for start in range(0, n, max(chunk_size, 1)):
+        end = min(start + chunk_size, n)
+        if (
+            start == 0
+            and end == n
+            and (scipy.sparse.issparse(X) or isinstance(X, np.ndarray))
+        ):
+            # in memory, so columns are taken from the cached CSC companion
+            chunk = csc_view(X) if csc or gene_idx is not None else X
+            if gene_idx is not None:
+                chunk = chunk[:, gene_idx]
+        else:
+            chunk = X[start:end]
+            if gene_idx is not None:
+                chunk = chunk[:, gene_idx]
+        if scipy.sparse.issparse(chunk):
+            if chunk.format not in ("csr", "csc"):
+                chunk = scipy.sparse.csr_matrix(chunk)
+        else:
+            chunk = np.asarray(chunk)
+        yield start, end, chunk
+
+
+def aggregate(
+    adata: AnnData,
+    keys: Union[List[str], str],
+    genes: Optional[Union[List[str], str]] = None,
+    stats: Sequence[str] = ("sum", "mean", "fraction", "var"),
+    layer: Optional[str] = None,
+    use_raw: bool = False,
+    expression_cutoff: float = 0.0,
+    chunk_size: Optional[int] = None,
+) -> Dict[str, DataFrame]:
+    """
+    Compute per-group expression statistics over `.obs` keys with sparse matrix products.
+
+    Parameters
+    ----------
+    adata : AnnData
+        input `AnnData` object. Can be backed or hold a dask array.
+    keys : Union[List[str], str]
+        column(s) in `.obs` to group by. Groups are the observed combinations.
+    genes : Optional[Union[List[str], str]], optional
+        gene(s) to aggregate. All genes if None.
+    stats : Sequence[str], optional
+        any of `sum`, `mean`, `fraction` (fraction of cells with expression
+        above `expression_cutoff`) and `var` (sample variance).
+    layer : Optional[str], optional
+        layer to use instead of `.X`.
+    use_raw : bool, optional
+        whether to use `.raw`.
+    expression_cutoff : float, optional
+        expression above which a cell counts as expressing the gene.
+    chunk_size : Optional[int], optional
+        number of cells to process at a time. All at once if None, or the
+        row chunks of a dask array.
+
+    Returns
+    -------
+    Dict[str, DataFrame]
+        groups x genes `DataFrame` for each requested statistic.
+    """
+    allowed = {"sum", "mean", "fraction", "var"}
+    if not set(stats).issubset(allowed):
+        raise ValueError(
+            "Unknown stats: {}. Choose from {}.".format(
+                sorted(set(stats) - allowed), sorted(allowed)
+            )
+        )
+    X, var_names = _get_matrix(adata, layer, use_raw)
+    if genes is None:
+        gene_idx = None
+        gene_names = var_names
+    else:
+        if type(genes) is not list:
+            genes = [genes]
+        gene_idx = var_names.get_indexer(genes)
+        if (gene_idx < 0).any():
+            raise KeyError(
+                "Genes not found: {}".format(
+                    [g for g, i in zip(genes, gene_idx) if i < 0]
+                )
+            )
+        gene_names = pd.Index(genes)
+    if type(keys) is not list:
+        keys = [keys]
+    codes, levels = _packed_codes(adata.obs, keys)
+    groups = _group_index(levels, keys)
+    n_cells = np.bincount(codes[codes >= 0], minlength=len(groups))
+    indicator = None
+
+    shape = (len(groups), len(gene_names))
+    sums = np.zeros(shape)
+    sq_sums = np.zeros(shape)
+    expressed = np.zeros(shape)
+    # group_stats works on CSC, so reuse the cached companion
+    chunks = _iter_chunks(X, gene_idx, chunk_size, csc=expression_cutoff >= 0)
+    for start, end, chunk in chunks:
+        if scipy.sparse.issparse(chunk) and expression_cutoff >= 0:
+            res = group_stats(chunk, codes[start:end], shape[0], expression_cutoff)
+        else:
+            if indicator is None:
+                indicator = group_indicator(adata, keys)[0].tocsc()
+            ind = indicator[:, start:end]
+            chunk = _dense(chunk).astype(np.float64, copy=False)
+            res = (
+                ind @ chunk,
+                ind @ (chunk * chunk),
+                ind @ (chunk > expression_cutoff).astype(np.float64),
+            )
+        for total, r in zip((sums, sq_sums, expressed), res):
+            total += r
+
+    out = {}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / n_cells[:, None]
+        if "sum" in stats:
+            out["sum"] = sums
+        if "mean" in stats:
+            out["mean"] = means
+        if "fraction" in stats:
+            out["fraction"] = expressed / n_cells[:, None]
+        if "var" in stats:
+            # the single-pass formula can dip just below zero for near-constant genes
+            out["var"] = np.clip(
+                (sq_sums - sums * means) / (n_cells[:, None] - 1), 0, None
+            )
+    return {
+        stat: pd.DataFrame(values, index=groups, columns=gene_names)
+        for stat, values in out.items()
+    }
+
+
+def pseudobulk(
+    adata: AnnData,
+    keys: Union[List[str], str],
+    layer: Optional[str] = None,
+    use_raw: bool = False,
+    min_cells: int = 10,
+    sep: str = "_",
+    chunk_size: Optional[int] = None,
+) -> AnnData:
+    """
+    Sum counts per group of cells for bulk DE, e.g. per sample and cell type.
+
+    Counts are summed with one sparse group-indicator product per chunk of
+    cells, so the expression matrix is never densified.
+
+    Parameters
+    ----------
+    adata : AnnData
+        input `AnnData` object. Can be backed or hold a dask array.
+    keys : Union[List[str], str]
+        column(s) in `.obs` to group by. Groups are the observed combinations.
+    layer : Optional[str], optional
+        layer of raw counts to use instead of `.X`.
+    use_raw : bool, optional
+        whether to use `.raw`.
+    min_cells : int, optional
+        minimum number of cells for a group to be kept.
+    sep : str, optional
+        separator between categories in the group names.
+    chunk_size : Optional[int], optional
+        number of cells to process at a time. All at once if None, or the
+        row chunks of a dask array.
+
+    Returns
+    -------
+    AnnData
+        groups x genes `AnnData` of summed counts, with the categories of
+        `keys` and the number of cells (`n_cells`) of each group in `.obs`.
+    """
+    if type(keys) is not list:
+        keys = [keys]
+    X, var_names = _get_matrix(adata, layer, use_raw)
+    var = adata.raw.var if use_raw else adata.var
+    indicator, groups = group_indicator(adata, keys)
+    n_cells = np.asarray(indicator.sum(axis=1)).ravel().astype(np.int64)
+    # drop small groups before summing
+    keep = n_cells >= min_cells
+    indicator = indicator[keep].tocsc()
+
+    sums = np.zeros((indicator.shape[0], X.shape[1]))
+    for start, end, chunk in _iter_chunks(X, None, chunk_size):
+        sums += _dense(indicator[:, start:end] @ chunk)
+
+    obs = groups[keep].to_frame(index=False)
+    obs["n_cells"] = n_cells[keep]
+    obs.index = pd.Index(
+        [sep.join(map(str, g)) for g in obs[keys].itertuples(index=False)]
+    )
+    for key in keys:
+        obs[key] = obs[key].astype("category")
+    return AnnData(sums, obs=obs, var=var.copy())
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# @Author: Kelvin
+# @Date:   2026-10-19 11:20:37
+# @Last Modified by:   Kelvin
+# @Last Modified time: 2026-10-19 11:20:37
+"""On-disk result cache keyed by fingerprints of the inputs."""
+import hashlib
+import os
+import pickle
+import scipy.sparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from anndata import AnnData
+from pathlib import Path
+from typing import Any, List, Mapping, Optional
+
+from ._utils import _is_dask
+
+# bump to invalidate all cached results when the cached functions change
+CACHE_VERSION = "1"
+# cached functions, each with its own subdirectory; nothing else is touched
+NAMESPACES = ("exportDEres", "cell_cycle_scoring")
+# number of values sampled from the expression matrix for the fingerprint
+N_SAMPLE = 1 << 20
+
+
+def _cache_dir() -> Path:
+    """
+    Return the cache directory.
+
+    Set with the `KTTOOLS_CACHE_DIR` environment variable, defaults to
+    `~/.cache/kttools`.
+
+    Returns
+    -------
+    Path
+        cache directory.
+    """
+    return Path(
+        os.environ.get(
+            "KTTOOLS_CACHE_DIR",
+            os.path.join(os.path.expanduser("~"), ".cache", "kttools"),
+        )
+    )
+
+
+def _max_size() -> int:
+    """
+    Return the maximum size of the cache in bytes.
+
+    Set with the `KTTOOLS_CACHE_MAX_SIZE` environment variable, defaults to 1 GB.
+
+    Returns
+    -------
+    int
+        maximum size in bytes.
+    """
+    return int(os.environ.get("KTTOOLS_CACHE_MAX_SIZE", 1 << 30))
+
+
+def _cache_files() -> List[Path]:
+    """
+    List the cached result files.
+
+    Only the subdirectories of the cached functions are searched, so other
+    files under the cache directory are never touched.
+
+    Returns
+    -------
+    List[Path]
+        cached result files.
+    """
+    directory = _cache_dir()
+    return [f for ns in NAMESPACES for f in (directory / ns).glob("*.pkl")]
+
+
+def clear_cache() -> None:
+    """Remove all cached results."""
+    for f in _cache_files():
+        try:
+            f.unlink()
+        except OSError:
+            continue
+
+
+def _update(h: "hashlib._Hash", x: Any) -> None:
+    """
+    Feed an array-like or plain python object into a hash.
+
+    Parameters
+    ----------
+    h : hashlib._Hash
+        hash to update.
+    x : Any
+        array, DataFrame, mapping or other object with a stable `repr`.
+    """
+    if isinstance(x, (pd.DataFrame, pd.Series, pd.Index)):
+        h.update(pd.util.hash_pandas_object(x, index=True).to_numpy().tobytes())
+        if isinstance(x, pd.DataFrame):
+            _update(h, x.columns)
+    elif isinstance(x, np.ndarray) and x.dtype.names is not None:
+        for field in x.dtype.names:
+            h.update(field.encode())
+            _update(h, x[field])
+    elif isinstance(x, np.ndarray):
+        h.update(str((x.dtype, x.shape)).encode())
+        if x.dtype.kind == "O":
+            h.update(pd.util.hash_array(x.ravel()).tobytes())
+        else:
+            h.update(np.ascontiguousarray(x).data)
+    elif isinstance(x, Mapping):
+        for k in sorted(x, key=str):
+            h.update(str(k).encode())
+            _update(h, x[k])
+    else:
+        h.update(repr(x).encode())
+
+
+def _sample(x: np.ndarray, n: int = N_SAMPLE) -> np.ndarray:
+    """
+    Take up to `n` evenly spaced values from a 1-D array.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        1-D array.
+    n : int, optional
+        number of values.
+
+    Returns
+    -------
+    np.ndarray
+        sampled values.
+    """
+    if x.shape[0] <= n:
+        return x
+    return x[np.linspace(0, x.shape[0] - 1, n).astype(np.int64)]
+
+
+def _fingerprint_matrix(h: "hashlib._Hash", X) -> None:
+    """
+    Feed a sample of an expression matrix into a hash.
+
+    Parameters
+    ----------
+    h : hashlib._Hash
+        hash to update.
+    X
+        sparse, dense or dask matrix.
+    """
+    h.update(str((X.shape, X.dtype)).encode())
+    if _is_dask(X):
+        # the name is a deterministic token of the task graph, nothing is computed
+        h.update(X.name.encode())
+    elif scipy.sparse.issparse(X):
+        h.update(str(X.nnz).encode())
+        for buf in (X.data, X.indices, X.indptr):
+            _update(h, _sample(buf))
+    else:
+        X = np.asarray(X)
+        n_rows = max(N_SAMPLE // max(X.shape[1], 1), 1)
+        rows = _sample(np.arange(X.shape[0]), n_rows)
+        _update(h, X[rows])
+
+
+def _fingerprint_de(de: Mapping, **params) -> str:
+    """
+    Fingerprint DE results and the export parameters.
+
+    Parameters
+    ----------
+    de : Mapping
+        DE results e.g. `adata.uns["rank_genes_groups"]`.
+    **params
+        parameters that change the exported table.
+
+    Returns
+    -------
+    str
+        hex digest.
+    """
+    h = hashlib.blake2b(CACHE_VERSION.encode(), digest_size=20)
+    _update(h, dict(de))
+    _update(h, params)
+    return h.hexdigest()
+
+
+def _fingerprint_cell_cycle(
+    adata: AnnData, s_genes: List[str], g2m_genes: List[str]
+) -> str:
+    """
+    Fingerprint the inputs of cell cycle scoring.
+
+    The expression matrix is sampled rather than hashed in full, so the
+    fingerprint stays cheap for large objects.
+
+    Parameters
+    ----------
+    adata : AnnData
+        input `AnnData` object.
+    s_genes : List[str]
+        S phase genes.
+    g2m_genes : List[str]
+        G2/M phase genes.
+
+    Returns
+    -------
+    str
+        hex digest.
+    """
+    h = hashlib.blake2b(CACHE_VERSION.encode(), digest_size=20)
+    if adata.raw is not None:
+        h.update(b"raw")
+        _fingerprint_matrix(h, adata.raw.X)
+        _update(h, adata.raw.var_names)
+    else:
+        _fingerprint_matrix(h, adata.X)
+        _update(h, adata.var_names)
+        _update(h, "log1p" in adata.uns)
+    _update(h, adata.obs_names)
+    _update(h, [s_genes, g2m_genes])
+    return h.hexdigest()
+
+
+def _cache_load(namespace: str, digest: str) -> Optional[Any]:
+    """
+    Load a cached result.
+
+    Parameters
+    ----------
+    namespace : str
+        name of the cached function.
+    digest : str
+        fingerprint of the inputs.
+
+    Returns
+    -------
+    Optional[Any]
+        the cached result, or None on a miss.
+    """
+    f = _cache_dir() / namespace / (digest + ".pkl")
+    try:
+        with open(f, "rb") as fh:
+            res = pickle.load(fh)
+        # mark as recently used for eviction
+        os.utime(f)
+    except Exception:
+        # missing, truncated or written by incompatible package versions
+        return None
+    return res
+
+
+def _cache_save(namespace: str, digest: str, obj: Any) -> None:
+    """
+    Store a result in the cache and evict the least recently used entries.
+
+    Parameters
+    ----------
+    namespace : str
+        name of the cached function.
+    digest : str
+        fingerprint of the inputs.
+    obj : Any
+        result to cache.
+    """
+    directory = _cache_dir() / namespace
+    directory.mkdir(parents=True, exist_ok=True)
+    # write to a temporary file first so concurrent readers never see a partial file
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            pickle.dump(obj, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, directory / (digest + ".pkl"))
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+    _evict(_max_size())
+
+
+def _evict(max_size: int) -> None:
+    """
+    Remove the least recently used cache entries until the cache fits `max_size`.
+
+    Parameters
+    ----------
+    max_size : int
+        maximum size in bytes.
+    """
+    entries = []
+    for f in _cache_files():
+        try:
+            st = f.stat()
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, f))
+    total = sum(size for _, size, _ in entries)
+    for _, size, f in sorted(entries, key=lambda e: e[0]):
+        if total <= max_size:
+            break
+        try:
+            f.unlink()
+        except OSError:
+            continue
+        total -= size
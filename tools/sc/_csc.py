@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# @Author: Kelvin
+# @Date:   2026-10-19 18:47:26
+# @Last Modified by:   Kelvin
+# @Last Modified time: 2026-10-19 18:47:26
+"""Cached column-major (CSC) companion of sparse expression matrices."""
+import hashlib
+import os
+import scipy.sparse
+import weakref
+
+import numpy as np
+
+from anndata import AnnData
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from ._utils import _get_matrix
+
+# CSC companions by id of their source matrix, dropped with the source
+_CSC_CACHE: Dict[int, Tuple[tuple, scipy.sparse.csc_matrix]] = {}
+
+
+def _signature(X) -> Tuple[tuple, str]:
+    """
+    Identify the content of a sparse matrix cheaply.
+
+    Parameters
+    ----------
+    X
+        sparse matrix.
+
+    Returns
+    -------
+    Tuple[tuple, str]
+        buffer addresses, and a digest of the shape, number of stored values
+        and a sample of them. The addresses change when the buffers are
+        replaced, the digest when the values are.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str((X.shape, X.nnz)).encode())
+    for buf in (X.data, X.indices, X.indptr):
+        step = max(buf.shape[0] // 256, 1)
+        h.update(np.ascontiguousarray(buf[::step]).data)
+    pointers = tuple(
+        buf.__array_interface__["data"][0] for buf in (X.data, X.indices, X.indptr)
+    )
+    return pointers, h.hexdigest()
+
+
+def _to_csc(X, n_jobs: int = 1) -> scipy.sparse.csc_matrix:
+    """
+    Convert a sparse matrix to CSC, optionally in parallel over blocks of columns.
+
+    Parameters
+    ----------
+    X
+        sparse matrix.
+    n_jobs : int, optional
+        number of threads.
+
+    Returns
+    -------
+    scipy.sparse.csc_matrix
+        CSC matrix with sorted indices.
+    """
+    if n_jobs > 1 and X.shape[1] > n_jobs:
+        bounds = np.linspace(0, X.shape[1], n_jobs + 1).astype(int)
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            blocks = list(
+                executor.map(
+                    lambda b: scipy.sparse.csc_matrix(X[:, b[0] : b[1]]),
+                    zip(bounds[:-1], bounds[1:]),
+                )
+            )
+        X = scipy.sparse.hstack(blocks, format="csc")
+    else:
+        X = scipy.sparse.csc_matrix(X)
+    if not X.has_sorted_indices:
+        X.sort_indices()
+    return X
+
+
+def _load_sidecar(filename: str, digest: str) -> Optional[scipy.sparse.csc_matrix]:
+    """
+    Load a CSC companion from a sidecar file if it matches the matrix.
+
+    Parameters
+    ----------
+    filename : str
+        path to `.npz` file.
+    digest : str
+        digest of the source matrix.
+
+    Returns
+    -------
+    Optional[scipy.sparse.csc_matrix]
+        the CSC matrix, or None if the file is missing or stale.
+    """
+    if not os.path.exists(filename):
+        return None
+    with np.load(filename) as f:
+        if str(f["digest"]) != digest:
+            return None
+        return scipy.sparse.csc_matrix(
+            (f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"])
+        )
+
+
+def _save_sidecar(filename: str, digest: str, X: scipy.sparse.csc_matrix) -> None:
+    """
+    Save a CSC companion to a sidecar file.
+
+    Parameters
+    ----------
+    filename : str
+        path to `.npz` file.
+    digest : str
+        digest of the source matrix.
+    X : scipy.sparse.csc_matrix
+        the CSC matrix.
+    """
+    tmp = filename + ".tmp.npz"
+    try:
+        np.savez(
+            tmp,
+            data=X.data,
+            indices=X.indices,
+            indptr=X.indptr,
+            shape=np.array(X.shape),
+            digest=np.array(digest),
+        )
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def csc_view(X, sidecar: Optional[str] = None, n_jobs: int = 1):
+    """
+    Return a CSC companion of a sparse matrix for fast column access.
+
+    The companion is built once and cached for as long as `X` is alive, so it
+    holds a full copy of the matrix until then or until `clear_csc`. It is
+    rebuilt if the buffers of `X` are replaced, or if its shape, number of
+    stored values or a sample of 1 in 256 stored values change. Other
+    in-place edits of the values go unnoticed: call `clear_csc` after them.
+    Matrices that are not in-memory sparse, or are CSC already, are returned
+    as they are.
+
+    Parameters
+    ----------
+    X
+        expression matrix.
+    sidecar : Optional[str], optional
+        `.npz` file to load the companion from, or to save it to once built.
+    n_jobs : int, optional
+        number of threads used to build the companion.
+
+    Returns
+    -------
+    scipy.sparse.csc_matrix or the input
+        matrix in CSC format.
+    """
+    if not scipy.sparse.issparse(X) or X.format == "csc":
+        return X
+    pointers, digest = _signature(X)
+    key = id(X)
+    cached = _CSC_CACHE.get(key)
+    if cached is not None and cached[0] == (pointers, digest):
+        return cached[1]
+    csc = _load_sidecar(sidecar, digest) if sidecar is not None else None
+    if csc is None:
+        csc = _to_csc(X, n_jobs=n_jobs)
+        if sidecar is not None:
+            _save_sidecar(sidecar, digest, csc)
+    if cached is None:
+        weakref.finalize(X, _CSC_CACHE.pop, key, None)
+    _CSC_CACHE[key] = ((pointers, digest), csc)
+    return csc
+
+
+def get_csc(
+    adata: AnnData,
+    use_raw: bool = False,
+    layer: Optional[str] = None,
+    sidecar: Optional[str] = None,
+    n_jobs: int = 1,
+):
+    """
+    Return the cached CSC companion of the expression matrix of an `AnnData`.
+
+    Gene-wise functions (`vmax`, `vmin`, `dotplot_2obs` and `aggregate`) use
+    the same cache, so calling this first only controls how the companion is
+    built, e.g. from a sidecar file or with several threads. The cache keeps a
+    full copy of the matrix and only samples its values to detect changes,
+    see `csc_view`. Use `clear_csc` to drop it.
+
+    Parameters
+    ----------
+    adata : AnnData
+        input `AnnData` object.
+    use_raw : bool, optional
+        whether to use `.raw`.
+    layer : Optional[str], optional
+        layer to use instead of `.X`.
+    sidecar : Optional[str], optional
+        `.npz` file to load the companion from, or to save it to once built.
+    n_jobs : int, optional
+        number of threads used to build the companion.
+
+    Returns
+    -------
+    scipy.sparse.csc_matrix
+        matrix in CSC format.
+    """
+    X, _ = _get_matrix(adata, layer, use_raw)
+    return csc_view(X, sidecar=sidecar, n_jobs=n_jobs)
+
+
+def clear_csc(
+    adata: Optional[AnnData] = None,
+    use_raw: bool = False,
+    layer: Optional[str] = None,
+) -> None:
+    """
+    Drop cached CSC companions.
+
+    Use to free their memory, or after editing the values of an expression
+    matrix in place.
+
+    Parameters
+    ----------
+    adata : Optional[AnnData], optional
+        `AnnData` object whose companion to drop. All companions if None.
+    use_raw : bool, optional
+        whether to drop the companion of `.raw`.
+    layer : Optional[str], optional
+        layer whose companion to drop instead of that of `.X`.
+    """
+    if adata is None:
+        _CSC_CACHE.clear()
+        return
+    X, _ = _get_matrix(adata, layer, use_raw)
+    _CSC_CACHE.pop(id(X), None)
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# @Author: Kelvin
+# @Date:   2026-10-19 16:24:05
+# @Last Modified by:   Kelvin
+# @Last Modified time: 2026-10-19 16:24:05
+"""Indexed on-disk store of DE results."""
+import h5py
+
+import numpy as np
+import pandas as pd
+
+from anndata import AnnData
+from pandas import DataFrame, Index
+from typing import List, Mapping, Optional, Union
+
+from ._sc import MITO_RIBO_REGEX, _DEres_arrays
+
+# statistics stored for every contrast, as genes x contrasts matrices
+FIELDS = ("scores", "logfoldchanges", "pvals", "pvals_adj", "pts", "pts_reference")
+# genes x contrasts per chunk, so a gene and a contrast are both a few chunk reads
+CHUNKS = (256, 16)
+
+
+def _drop_missing_pts(res: DataFrame) -> DataFrame:
+    """
+    Drop the pts columns of results computed without `pts=True`.
+
+    Parameters
+    ----------
+    res : DataFrame
+        DE results.
+
+    Returns
+    -------
+    DataFrame
+        DE results with the pts columns only if any value is present.
+    """
+    missing = [c for c in ("pts", "pts_reference") if res[c].isna().all()]
+    return res.drop(columns=missing)
+
+
+class DEStore:
+    """
+    On-disk store of DE results from many keys and contrasts, indexed by gene.
+
+    Each statistic is a chunked genes x contrasts matrix in an HDF5 file, with
+    the gene names and contrast names alongside. The gene -> row index is
+    built when the store is opened, so looking up one gene in every contrast,
+    or one contrast for every gene, reads only the chunks holding that row or
+    column. New contrasts and genes can be appended at any time.
+
+    Parameters
+    ----------
+    filename : str
+        path to the `.h5` file. Created if it does not exist.
+    mode : str, optional
+        `r` to read only, `a` to read and append.
+
+    Examples
+    --------
+    >>> with DEStore("de.h5") as store:
+    ...     store.add(adata, key="rank_genes_groups", name="celltype")
+    ...     store.gene("CD8A")
+    ...     store.contrast("celltype:CD8 T")
+    """
+
+    def __init__(self, filename: str, mode: str = "a"):
+        if mode not in ("r", "a"):
+            raise ValueError("`mode` must be 'r' or 'a'.")
+        self.filename = filename
+        self._file = h5py.File(filename, mode)
+        if "genes" not in self._file:
+            if mode == "r":
+                self._file.close()
+                raise ValueError("{} is not a DE store.".format(filename))
+            self._create()
+        self._genes = pd.Index(self._file["genes"].asstr()[:])
+        self._contrasts = pd.Index(self._file["contrasts"].asstr()[:])
+
+    def _create(self) -> None:
+        """Lay out an empty store."""
+        f = self._file
+        for name in ("genes", "contrasts", "references"):
+            f.create_dataset(
+                name, shape=(0,), maxshape=(None,), dtype=h5py.string_dtype()
+            )
+        stats = f.create_group("stats")
+        for field in FIELDS:
+            stats.create_dataset(
+                field,
+                shape=(0, 0),
+                maxshape=(None, None),
+                chunks=CHUNKS,
+                dtype=np.float64,
+                fillvalue=np.nan,
+            )
+        # position of each gene in the ranking of each contrast, -1 if absent
+        stats.create_dataset(
+            "rank",
+            shape=(0, 0),
+            maxshape=(None, None),
+            chunks=CHUNKS,
+            dtype=np.int64,
+            fillvalue=-1,
+        )
+
+    @property
+    def genes(self) -> Index:
+        """Genes in the store, in row order."""
+        return self._genes
+
+    @property
+    def contrasts(self) -> Index:
+        """Contrasts in the store, in column order."""
+        return self._contrasts
+
+    def _read(self, field: str, index) -> np.ndarray:
+        """Read a statistic in the type of the results it was added from."""
+        dset = self._file["stats"][field]
+        return dset[index].astype(dset.attrs.get("dtype", dset.dtype), copy=False)
+
+    def _append(self, name: str, values: List[str]) -> None:
+        """Append strings to a one dimensional dataset."""
+        dset = self._file[name]
+        n = dset.shape[0]
+        dset.resize((n + len(values),))
+        dset[n:] = values
+
+    def add(
+        self,
+        de: Union[AnnData, Mapping],
+        key: str = "rank_genes_groups",
+        columns: Optional[Union[List[str], str]] = None,
+        name: Optional[str] = None,
+        overwrite: bool = False,
+    ) -> List[str]:
+        """
+        Add DE results of one `sc.tl.rank_genes_groups` run to the store.
+
+        Parameters
+        ----------
+        de : Union[AnnData, Mapping]
+            `AnnData` object with the results in `.uns[key]`, or the results.
+        key : str, optional
+            name in `.uns` to retrieve DE results.
+        columns : Optional[Union[List[str], str]], optional
+            contrasts to add. All contrasts if None.
+        name : Optional[str], optional
+            prefix of the stored contrast names (`<name>:<column>`). `key` if None.
+        overwrite : bool, optional
+            whether to replace contrasts already in the store.
+
+        Returns
+        -------
+        List[str]
+            names of the stored contrasts.
+        """
+        if isinstance(de, AnnData):
+            de = de.uns[key]
+        if name is None:
+            name = key
+        if columns is None:
+            columns = list(de["scores"].dtype.fields.keys())
+        elif type(columns) is not list:
+            columns = [columns]
+        labels = [name + ":" + column for column in columns]
+        existing = [label for label in labels if label in self._contrasts]
+        if len(existing) > 0 and not overwrite:
+            raise ValueError("Contrasts already in the store: {}".format(existing))
+
+        reference = de["params"]["reference"]
+        parts = []
+        for column in columns:
+            arrays, keep = _DEres_arrays(de, column, remove_mito_ribo=False)
+            parts.append((column, arrays, np.flatnonzero(keep)))
+
+        # extend the gene index with genes not seen before
+        new = pd.Index(
+            pd.unique(np.concatenate([a["names"][k] for _, a, k in parts]))
+        ).difference(self._genes, sort=False)
+        stats = self._file["stats"]
+        if len(new) > 0:
+            self._append("genes", list(new))
+            self._genes = self._genes.append(new)
+        new_labels = [label for label in labels if label not in self._contrasts]
+        if len(new_labels) > 0:
+            self._append("contrasts", new_labels)
+            self._append("references", [reference] * len(new_labels))
+            self._contrasts = self._contrasts.append(pd.Index(new_labels))
+        shape = (len(self._genes), len(self._contrasts))
+        for dset in stats.values():
+            dset.resize(shape)
+
+        for label, (column, arrays, keep) in zip(labels, parts):
+            j = self._contrasts.get_loc(label)
+            self._file["references"][j] = reference
+            rows = self._genes.get_indexer(arrays["names"][keep])
+            # write whole columns so replaced contrasts leave nothing behind
+            rank = np.full(shape[0], -1, dtype=np.int64)
+            rank[rows] = keep
+            stats["rank"][:, j] = rank
+            renamed = {"pts_" + column: "pts", "pts_" + reference: "pts_reference"}
+            for field, values in arrays.items():
+                field = renamed.get(field, field)
+                if field in FIELDS:
+                    col = np.full(shape[0], np.nan)
+                    col[rows] = values[keep]
+                    stats[field][:, j] = col
+                    # stored as float64, read back in the type of the results
+                    dtype = stats[field].attrs.get("dtype", values.dtype.str)
+                    stats[field].attrs["dtype"] = np.result_type(
+                        dtype, values.dtype
+                    ).str
+        self._file.flush()
+        return labels
+
+    def gene(self, genes: Union[List[str], str]) -> DataFrame:
+        """
+        Look up the statistics of gene(s) in every contrast.
+
+        Parameters
+        ----------
+        genes : Union[List[str], str]
+            gene(s) to look up.
+
+        Returns
+        -------
+        DataFrame
+            one row per gene and contrast the gene was tested in, indexed by
+            contrast (and gene if several are requested).
+        """
+        single = type(genes) is not list
+        if single:
+            genes = [genes]
+        rows = self._genes.get_indexer(genes)
+        if (rows < 0).any():
+            raise KeyError(
+                "Genes not found: {}".format([g for g, i in zip(genes, rows) if i < 0])
+            )
+        # h5py reads sorted, unique coordinates
+        order, inverse = np.unique(rows, return_inverse=True)
+        res = pd.DataFrame(
+            {
+                field: self._read(field, (order, slice(None)))[inverse].ravel()
+                for field in ("rank",) + FIELDS
+            },
+            index=pd.MultiIndex.from_product(
+                [genes, self._contrasts], names=["gene", "contrast"]
+            ),
+        )
+        res = res[res["rank"] >= 0].drop(columns="rank")
+        res = _drop_missing_pts(res)
+        if single:
+            res = res.droplevel("gene")
+        return res
+
+    def contrast(self, contrast: str, remove_mito_ribo: bool = True) -> DataFrame:
+        """
+        Return one contrast in the format of `returnDEres`.
+
+        Parameters
+        ----------
+        contrast : str
+            stored contrast name, `<name>:<column>`.
+        remove_mito_ribo : bool, optional
+            whether to filter all mito and ribo genes.
+
+        Returns
+        -------
+        DataFrame
+            `DataFrame` of DE results, in the order of the ranking.
+        """
+        j = self._contrasts.get_loc(contrast)
+        stats = self._file["stats"]
+        rank = stats["rank"][:, j]
+        rows = np.flatnonzero(rank >= 0)
+        rows = rows[np.argsort(rank[rows], kind="stable")]
+        column = contrast.split(":", 1)[1]
+        reference = self._file["references"].asstr()[j]
+        res = pd.DataFrame(
+            {field: self._read(field, (slice(None), j))[rows] for field in FIELDS},
+            index=pd.Index(self._genes[rows]),
+        )
+        res = _drop_missing_pts(res).rename(
+            columns={"pts": "pts_" + column, "pts_reference": "pts_" + reference}
+        )
+        if remove_mito_ribo:
+            res = res[~res.index.str.contains(MITO_RIBO_REGEX)]
+        return res
+
+    def close(self) -> None:
+        """Close the store."""
+        self._file.close()
+
+    def __enter__(self) -> "DEStore":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# @Author: Kelvin
+# @Date:   2026-10-19 17:05:43
+# @Last Modified by:   Kelvin
+# @Last Modified time: 2026-10-19 17:05:43
+"""
+Per-gene and per-group statistics over sparse matrix buffers.
+
+Numba kernels are used for the group statistics and column means when numba is
+installed (`pip install kttools[numba]`), and NumPy/SciPy otherwise. Both give
+the same results. The kernels release the GIL and run over genes in parallel
+threads. Set the `KTTOOLS_DISABLE_NUMBA` environment variable to force the
+NumPy/SciPy versions. Quantiles always use NumPy selection, which is as fast.
+"""
+import os
+import scipy.sparse
+
+import numpy as np
+
+from typing import Sequence, Tuple
+
+try:
+    import numba
+
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+
+def _use_numba() -> bool:
+    """
+    Check if the numba kernels should be used.
+
+    Returns
+    -------
+    bool
+        whether numba is installed and not disabled.
+    """
+    return HAS_NUMBA and not os.environ.get("KTTOOLS_DISABLE_NUMBA")
+
+
+def _fork_unsafe() -> bool:
+    """
+    Check if forking this process could hang it.
+
+    Forking after numba has started its TBB thread pool hangs the parent at
+    exit. The OpenMP and workqueue layers are not affected.
+
+    Returns
+    -------
+    bool
+        whether a parallel numba kernel has run on the TBB threading layer.
+    """
+    if not HAS_NUMBA:
+        return False
+    from numba.np.ufunc import parallel
+
+    return getattr(parallel, "_is_initialized", False) and (
+        numba.threading_layer() == "tbb"
+    )
+
+
+def _quantile_position(n: int, q: float, dtype: np.dtype) -> Tuple[int, int, float]:
+    """
+    Locate a quantile among `n` sorted values, as `np.quantile` does.
+
+    Parameters
+    ----------
+    n : int
+        number of values.
+    q : float
+        quantile.
+    dtype : np.dtype
+        floating point type the quantile is computed in.
+
+    Returns
+    -------
+    Tuple[int, int, float]
+        ranks of the values below and above and the interpolation weight.
+    """
+    # same arithmetic as numpy's default (linear) method, which casts `q` to
+    # the floating point type of the data
+    q = dtype.type(q)
+    virtual = (n - 1) * q
+    below = np.floor(virtual)
+    gamma = virtual - below
+    below = min(max(int(below), 0), n - 1)
+    above = min(below + 1, n - 1)
+    return below, above, gamma
+
+
+def _lerp(a: float, b: float, t: float) -> float:
+    """Interpolate between `a` and `b` as `np.quantile` does."""
+    diff = b - a
+    if t >= 0.5:
+        return b - diff * (1 - t)
+    return a + diff * t
+
+
+def _ranked(values: np.ndarray, n_zeros: int, rank: int) -> float:
+    """
+    Return the value of a given rank among stored values and implicit zeros.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        stored values, in any order.
+    n_zeros : int
+        number of implicit zeros.
+    rank : int
+        rank of the value.
+
+    Returns
+    -------
+    float
+        the value.
+    """
+    n_neg = (values < 0).sum()
+    if rank >= n_neg + n_zeros:
+        rank -= n_zeros
+    elif rank >= n_neg:
+        return 0.0
+    # selection instead of a full sort
+    return np.partition(values, rank)[rank]
+
+
+def _column_quantiles_numpy(
+    indptr: np.ndarray, data: np.ndarray, n_rows: int, q: float
+) -> np.ndarray:
+    """Compute `column_quantiles` over CSC buffers."""
+    dtype = data.dtype if data.dtype.kind == "f" else np.dtype(np.float64)
+    data = data.astype(dtype, copy=False)
+    below, above, gamma = _quantile_position(n_rows, q, dtype)
+    out = np.empty(indptr.shape[0] - 1, dtype=dtype)
+    for j in range(out.shape[0]):
+        values = data[indptr[j] : indptr[j + 1]]
+        n_zeros = n_rows - values.shape[0]
+        out[j] = _lerp(
+            _ranked(values, n_zeros, below), _ranked(values, n_zeros, above), gamma
+        )
+    return out
+
+
+def _group_stats_numpy(
+    X: scipy.sparse.csc_matrix,
+    codes: np.ndarray,
+    n_groups: int,
+    cutoff: float,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """SciPy version of `group_stats`, with one indicator product per statistic."""
+    keep = codes >= 0
+    indicator = scipy.sparse.csr_matrix(
+        (np.ones(keep.sum()), (codes[keep], np.flatnonzero(keep))),
+        shape=(n_groups, X.shape[0]),
+    )
+    X = X.astype(np.float64)
+    return (
+        (indicator @ X).toarray(),
+        (indicator @ X.multiply(X)).toarray(),
+        (indicator @ (X > cutoff).astype(np.float64)).toarray(),
+    )
+
+
+if HAS_NUMBA:
+
+    @numba.njit(parallel=True, nogil=True, cache=True)
+    def _group_stats_numba(indptr, indices, data, codes, n_groups, cutoff):
+        n_cols = indptr.shape[0] - 1
+        sums = np.zeros((n_groups, n_cols))
+        sq_sums = np.zeros((n_groups, n_cols))
+        expressed = np.zeros((n_groups, n_cols))
+        # each thread owns whole columns, so no accumulator is shared
+        for j in numba.prange(n_cols):
+            for k in range(indptr[j], indptr[j + 1]):
+                g = codes[indices[k]]
+                if g < 0:
+                    continue
+                v = np.float64(data[k])
+                sums[g, j] += v
+                sq_sums[g, j] += v * v
+                if v > cutoff:
+                    expressed[g, j] += 1.0
+        return sums, sq_sums, expressed
+
+    @numba.njit(parallel=True, nogil=True, cache=True)
+    def _column_sums_numba(indptr, indices, data, n_cols, n_threads):
+        n_rows = indptr.shape[0] - 1
+        step = (n_rows + n_threads - 1) // n_threads
+        # one accumulator per thread, summed at the end
+        partial = np.zeros((n_threads, n_cols))
+        for t in numba.prange(n_threads):
+            for r in range(t * step, min((t + 1) * step, n_rows)):
+                for k in range(indptr[r], indptr[r + 1]):
+                    partial[t, indices[k]] += data[k]
+        return partial.sum(axis=0)
+
+
+def _csc(X) -> scipy.sparse.csc_matrix:
+    """
+    Return a sparse matrix in CSC format with sorted indices.
+
+    Parameters
+    ----------
+    X
+        sparse matrix.
+
+    Returns
+    -------
+    scipy.sparse.csc_matrix
+        CSC matrix.
+    """
+    X = scipy.sparse.csc_matrix(X)
+    if not X.has_sorted_indices:
+        X = X.sorted_indices()
+    return X
+
+
+def column_quantiles(X, idx: Sequence[int], q: float) -> np.ndarray:
+    """
+    Compute a quantile of selected columns, counting implicit zeros.
+
+    Only the stored values of each column are searched, so the cost does not
+    depend on the number of zeros.
+
+    Parameters
+    ----------
+    X
+        sparse or dense matrix.
+    idx : Sequence[int]
+        column positions.
+    q : float
+        quantile between 0 and 1.
+
+    Returns
+    -------
+    np.ndarray
+        quantile of each column, equal to `np.quantile` on the dense columns.
+        Computed in the floating point type of `X`, as `np.quantile` does.
+    """
+    if not scipy.sparse.issparse(X):
+        return np.quantile(np.asarray(X)[:, idx], q, axis=0)
+    # selection is memory bound, so numba does not beat np.partition here
+    X = _csc(X[:, idx])
+    return _column_quantiles_numpy(X.indptr, X.data, X.shape[0], q)
+
+
+def group_stats(
+    X, codes: np.ndarray, n_groups: int, cutoff: float = 0.0
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Sum values, squared values and values above `cutoff` per group of rows.
+
+    Parameters
+    ----------
+    X
+        sparse matrix.
+    codes : np.ndarray
+        group of each row, -1 for rows in no group.
+    n_groups : int
+        number of groups.
+    cutoff : float, optional
+        value above which an entry counts as expressed. Must not be negative,
+        as implicit zeros are never counted.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        groups x columns sums, sums of squares and counts above `cutoff`.
+    """
+    X = _csc(X)
+    if _use_numba():
+        return _group_stats_numba(
+            X.indptr, X.indices, X.data, codes, n_groups, float(cutoff)
+        )
+    return _group_stats_numpy(X, codes, n_groups, cutoff)
+
+
+def column_means(X) -> np.ndarray:
+    """
+    Compute the mean of every column.
+
+    Parameters
+    ----------
+    X
+        sparse or dense matrix.
+
+    Returns
+    -------
+    np.ndarray
+        mean of each column.
+    """
+    if not scipy.sparse.issparse(X):
+        return np.asarray(X).mean(axis=0, dtype=np.float64)
+    X = scipy.sparse.csr_matrix(X)
+    if _use_numba():
+        sums = _column_sums_numba(
+            X.indptr, X.indices, X.data, X.shape[1], numba.get_num_threads()
+        )
+    else:
+        sums = np.bincount(X.indices, weights=X.data, minlength=X.shape[1])
+    return sums / X.shape[0]
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# @Author: Kelvin
+# @Date:   2026-10-19 12:41:09
+# @Last Modified by:   Kelvin
+# @Last Modified time: 2026-10-19 12:41:09
+"""Run kttools steps over a directory of `.h5ad` files."""
+import json
+import os
+import time
+import traceback
+
+import anndata as ad
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pandas import DataFrame
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from ._shared import _mp_context
+
+MANIFEST = "kttools_manifest.jsonl"
+
+Step = Union[str, Callable, Tuple[Union[str, Callable], Dict]]
+
+
+def _resolve_step(step: Step) -> Tuple[str, Callable, Dict]:
+    """
+    Turn a step specification into a name, function and keyword arguments.
+
+    Parameters
+    ----------
+    step : Step
+        function, name of a function in `tools.sc`, or a tuple of either and a
+        dictionary of keyword arguments.
+
+    Returns
+    -------
+    Tuple[str, Callable, Dict]
+        name, function and keyword arguments.
+    """
+    if isinstance(step, tuple):
+        func, kwargs = step
+    else:
+        func, kwargs = step, {}
+    if isinstance(func, str):
+        from .. import sc as _sc_module
+
+        if func not in _sc_module.__all__:
+            raise ValueError("Unknown step: {}.".format(func))
+        func = getattr(_sc_module, func)
+    return func.__name__, func, dict(kwargs)
+
+
+def _steps_signature(steps: List[Step]) -> str:
+    """
+    Describe the configured steps, so a changed configuration is not resumed.
+
+    Parameters
+    ----------
+    steps : List[Step]
+        configured steps.
+
+    Returns
+    -------
+    str
+        signature of the steps.
+    """
+    return repr(
+        [(name, sorted(kw.items())) for name, _, kw in map(_resolve_step, steps)]
+    )
+
+
+def _limit_memory(memory_limit: Optional[int]) -> None:
+    """
+    Lower the soft address space limit of a worker process.
+
+    Only the soft limit is changed, the hard limit is left alone.
+
+    Parameters
+    ----------
+    memory_limit : Optional[int]
+        limit in bytes. No limit if None.
+    """
+    if memory_limit is not None:
+        import resource
+
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard))
+
+
+def _check_memory_limit(memory_limit: Optional[int]) -> None:
+    """
+    Check in the parent process that the memory limit can be applied by the workers.
+
+    Parameters
+    ----------
+    memory_limit : Optional[int]
+        limit in bytes. No limit if None.
+    """
+    if memory_limit is None:
+        return
+    try:
+        import resource
+    except ImportError:
+        raise ValueError("`memory_limit` is only supported on POSIX systems.")
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if memory_limit <= 0 or (hard != resource.RLIM_INFINITY and memory_limit > hard):
+        raise ValueError(
+            "`memory_limit` must be positive and at most the hard limit "
+            "of {} bytes.".format(hard)
+        )
+
+
+def _format_placeholders(value: str, stem: str, output_dir: str) -> str:
+    """
+    Substitute the `{stem}` and `{output_dir}` placeholders in a string.
+
+    Other braces, e.g. in a regular expression, are left untouched.
+
+    Parameters
+    ----------
+    value : str
+        string argument of a step.
+    stem : str
+        stem of the input file name.
+    output_dir : str
+        output directory.
+
+    Returns
+    -------
+    str
+        string with the placeholders substituted.
+    """
+    return value.replace("{stem}", stem).replace("{output_dir}", output_dir)
+
+
+def _run_file(
+    filename: str, steps: List[Step], output_dir: str, write_h5ad: bool
+) -> Dict:
+    """
+    Run all steps on one file (runs in a worker process).
+
+    Parameters
+    ----------
+    filename : str
+        input `.h5ad` file.
+    steps : List[Step]
+        configured steps.
+    output_dir : str
+        output directory.
+    write_h5ad : bool
+        whether to write the processed object to `output_dir`.
+
+    Returns
+    -------
+    Dict
+        record of the run with per-step timings in seconds.
+    """
+    stem = Path(filename).stem
+    record = {"file": os.path.basename(filename), "status": "done", "error": None}
+    start = time.perf_counter()
+    try:
+        t = time.perf_counter()
+        adata = ad.read_h5ad(filename)
+        record["read"] = time.perf_counter() - t
+        for name, func, kwargs in map(_resolve_step, steps):
+            kwargs = {
+                k: (
+                    _format_placeholders(v, stem, output_dir)
+                    if isinstance(v, str)
+                    else v
+                )
+                for k, v in kwargs.items()
+            }
+            t = time.perf_counter()
+            func(adata, **kwargs)
+            record[name] = time.perf_counter() - t
+        if write_h5ad:
+            t = time.perf_counter()
+            adata.write_h5ad(os.path.join(output_dir, os.path.basename(filename)))
+            record["write"] = time.perf_counter() - t
+    except MemoryError:
+        record.update(status="failed", error="MemoryError: memory limit exceeded")
+    except Exception:
+        record.update(status="failed", error=traceback.format_exc(limit=-1).strip())
+    record["total"] = time.perf_counter() - start
+    return record
+
+
+def _read_manifest(manifest: Path) -> Dict[str, Dict]:
+    """
+    Read completed runs from a manifest.
+
+    Parameters
+    ----------
+    manifest : Path
+        path to manifest.
+
+    Returns
+    -------
+    Dict[str, Dict]
+        last completed record for each file.
+    """
+    done = {}
+    if manifest.exists():
+        with open(manifest) as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # partially written line from an interrupted run
+                    continue
+                if record.get("status") == "done":
+                    done[record["file"]] = record
+    return done
+
+
+def run_pipeline(
+    input_dir: str,
+    steps: List[Step],
+    output_dir: str,
+    pattern: str = "*.h5ad",
+    n_jobs: int = 1,
+    memory_limit: Optional[int] = None,
+    write_h5ad: bool = True,
+    resume: bool = True,
+) -> DataFrame:
+    """
+    Run a sequence of kttools functions over every `.h5ad` file in a directory.
+
+    Each file is processed in a worker process. Finished files are recorded in
+    `kttools_manifest.jsonl` in `output_dir`, so an interrupted run picks up
+    where it stopped. Files are rerun if they or the configured steps change.
+
+    Parameters
+    ----------
+    input_dir : str
+        directory of input files.
+    steps : List[Step]
+        functions applied to each `AnnData` in order. Each step is a function
+        or the name of a function in `tools.sc`, optionally paired with a
+        dictionary of keyword arguments in a tuple. String arguments can
+        contain `{stem}` and `{output_dir}` placeholders, e.g.
+        `("exportDEres", {"filename": "{output_dir}/{stem}_de.tsv"})`.
+    output_dir : str
+        output directory.
+    pattern : str, optional
+        glob pattern of input files.
+    n_jobs : int, optional
+        number of worker processes.
+    memory_limit : Optional[int], optional
+        maximum address space in bytes for each worker process. Files that
+        exceed it are reported as failed. No limit if None (POSIX only).
+    write_h5ad : bool, optional
+        whether to write the processed objects to `output_dir`.
+    resume : bool, optional
+        whether to skip files already completed in the manifest.
+
+    Returns
+    -------
+    DataFrame
+        one row per file, with status, error and timings in seconds for
+        reading, each step, writing and in total.
+    """
+    # fail early on unknown steps
+    signature = _steps_signature(steps)
+    _check_memory_limit(memory_limit)
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = Path(output_dir) / MANIFEST
+    done = _read_manifest(manifest) if resume else {}
+
+    records, todo = [], {}
+    for f in sorted(Path(input_dir).glob(pattern)):
+        st = f.stat()
+        previous = done.get(f.name)
+        if (
+            previous is not None
+            and previous.get("size") == st.st_size
+            and previous.get("mtime") == st.st_mtime
+            and previous.get("steps") == signature
+        ):
+            records.append(dict(previous, status="skipped"))
+        else:
+            todo[str(f)] = {"size": st.st_size, "mtime": st.st_mtime}
+
+    with ProcessPoolExecutor(
+        max_workers=n_jobs,
+        mp_context=_mp_context(),
+        initializer=_limit_memory,
+        initargs=(memory_limit,),
+    ) as executor, open(manifest, "a") as fh:
+        futures = {
+            executor.submit(_run_file, f, steps, output_dir, write_h5ad): f
+            for f in todo
+        }
+        for future in as_completed(futures):
+            f = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                # the worker died e.g. killed by the operating system
+                record = {
+                    "file": os.path.basename(f),
+                    "status": "failed",
+                    "error": repr(e),
+                }
+            record.update(todo[f], steps=signature)
+            fh.write(json.dumps(record) + "\n")
+            fh.flush()
+            records.append(record)
+
+    report = pd.DataFrame(records)
+    if report.shape[0] > 0:
+        report = (
+            report.drop(columns=["size", "mtime", "steps"], errors="ignore")
+            .set_index("file")
+            .sort_index()
+        )
+    return report
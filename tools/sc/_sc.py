@@ -4,18 +4,38 @@
 # @Last Modified by:   Kelvin
 # @Last Modified time: 2022-11-17 16:09:57
 """Miscellaneous single-cell functions."""
-import functools
+import hashlib
 import math
+import matplotlib
+import os
 import scipy.sparse
 
+import matplotlib.pyplot as plt
 import numpy as np
 import scanpy as sc
 import pandas as pd
 
 from anndata import AnnData
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
 from pandas import DataFrame
 from scanpy.pl._dotplot import DotPlot
-from typing import List, Union
+from typing import Dict, List, Mapping, Optional, Tuple, Union
+
+from ._aggregate import aggregate, _packed_codes
+from ._csc import csc_view
+from ._kernels import column_means, column_quantiles
+from ._utils import _dense, _detect_data_state, _gene_column
+from ._shared import SharedPool, _start_executor
+from ._cache import (
+    _cache_load,
+    _cache_save,
+    _fingerprint_cell_cycle,
+    _fingerprint_de,
+    _fingerprint_matrix,
+)
 
 
 def exportDEres(
@@ -24,6 +44,7 @@ def exportDEres(
     filename: str = None,
     remove_mito_ribo: bool = True,
     key: str = "rank_genes_groups",
+    use_cache: bool = False,
 ) -> DataFrame:
     """
     Export DE results from scanpy.
@@ -40,6 +61,9 @@ def exportDEres(
         whether to filter all mito and ribo genes in the output.
     key : str, optional
         name in `.uns` to retrieve DE results.
+    use_cache : bool, optional
+        whether to restore the table from the on-disk result cache if the DE
+        results are unchanged, and to store it there otherwise.
 
     Returns
     -------
@@ -51,31 +75,136 @@ def exportDEres(
     else:
         column = column
 
-    if filename is not None:
-        df_final = returnDEres(
-            adata,
-            column=column,
-            remove_mito_ribo=remove_mito_ribo,
-            key=key,
+    df = None
+    if use_cache:
+        digest = _fingerprint_de(
+            adata.uns[key], column=column, remove_mito_ribo=remove_mito_ribo
         )
-        df_final.to_csv(filename, sep="\t")
-    else:
+        df = _cache_load("exportDEres", digest)
+    if df is None:
         df = returnDEres(
             adata,
             column=column,
             remove_mito_ribo=remove_mito_ribo,
             key=key,
         )
+        if use_cache:
+            _cache_save("exportDEres", digest, df)
+
+    if filename is not None:
+        df.to_csv(filename, sep="\t")
+    else:
         return df
 
 
+MITO_RIBO_REGEX = "^(?:RPL|RPS|MRPS|MRPL|MT-|Rpl|Rps|Mrps|Mrpl|mt-)"
+# name in `.uns` of the fitted cell cycle scoring parameters
+CELL_CYCLE_REFERENCE = "cell_cycle_reference"
+
+
+def _DEres_arrays(
+    de: Mapping, column: str, remove_mito_ribo: bool = True
+) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+    """
+    Expose one contrast of `sc.tl.rank_genes_groups` results as column arrays.
+
+    Parameters
+    ----------
+    de : Mapping
+        DE results e.g. `adata.uns["rank_genes_groups"]`.
+    column : str
+        specific contrast to return.
+    remove_mito_ribo : bool, optional
+        whether to mask all mito and ribo genes.
+
+    Returns
+    -------
+    Tuple[Dict[str, np.ndarray], np.ndarray]
+        column arrays (gene names under `names`) and a boolean mask of the rows to keep.
+    """
+    reference = de["params"]["reference"]
+    names = de["names"][column]
+    # fields of the structured arrays are views, nothing is copied here
+    arrays = {"names": names}
+    for field in ["scores", "logfoldchanges", "pvals", "pvals_adj"]:
+        arrays[field] = de[field][column]
+    if "pts" in de and "pts_" + reference in de:
+        # pts are gene-indexed DataFrames so they need aligning to the ranking
+        arrays["pts_" + column] = de["pts"][column].reindex(names).to_numpy()
+        arrays["pts_" + reference] = (
+            de["pts_" + reference][column].reindex(names).to_numpy()
+        )
+    keep = ~pd.isna(names)
+    if remove_mito_ribo:
+        mito_ribo = pd.Index(names).str.contains(MITO_RIBO_REGEX, na=False)
+        keep &= ~np.asarray(mito_ribo)
+    return arrays, keep
+
+
+def viewDEres(
+    adata: AnnData,
+    column: str = None,
+    remove_mito_ribo: bool = True,
+    key: str = "rank_genes_groups",
+) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+    """
+    Return DE results as zero-copy column views without building a `DataFrame`.
+
+    The score, log fold change and p value columns are views into the
+    structured arrays in `.uns[key]`. Rows with a missing gene name (and mito
+    and ribo genes if requested) are flagged in a mask rather than dropped, so
+    nothing is copied until the caller indexes the arrays with it.
+
+    Parameters
+    ----------
+    adata : AnnData
+        AnnData object with `sc.tl.rank_genes_groups` performed.
+    column : Optional[str], optional
+        specific contrast to return.
+    remove_mito_ribo : bool, optional
+        whether to mask all mito and ribo genes.
+    key : str, optional
+        name in `.uns` to retrieve DE results.
+
+    Returns
+    -------
+    Tuple[Dict[str, np.ndarray], np.ndarray]
+        column arrays (gene names under `names`) and a boolean mask of the rows to keep.
+    """
+    if column is None:
+        column = list(adata.uns[key]["scores"].dtype.fields.keys())[0]
+    return _DEres_arrays(adata.uns[key], column, remove_mito_ribo=remove_mito_ribo)
+
+
+def _DEres_frame(arrays: Dict[str, np.ndarray], keep: np.ndarray) -> DataFrame:
+    """
+    Copy the kept rows of DE column arrays into a `DataFrame`.
+
+    Parameters
+    ----------
+    arrays : Dict[str, np.ndarray]
+        column arrays with gene names under `names`.
+    keep : np.ndarray
+        boolean mask of the rows to keep.
+
+    Returns
+    -------
+    DataFrame
+        `DataFrame` of DE results.
+    """
+    return DataFrame(
+        {k: v[keep] for k, v in arrays.items() if k != "names"},
+        index=pd.Index(arrays["names"][keep]),
+    )
+
+
 def returnDEres(
     adata: AnnData,
     column: str = None,
     remove_mito_ribo: bool = True,
     key: str = "rank_genes_groups",
 ) -> DataFrame:
-    """Summary
+    """Return DE results from scanpy as a `DataFrame`.
 
     Parameters
     ----------
@@ -97,85 +226,18 @@ def returnDEres(
         key = "rank_genes_groups"
     else:
         key = key
-
-    if column is None:
-        column = list(adata.uns[key]["scores"].dtype.fields.keys())[0]
-    else:
-        column = column
-    reference = adata.uns["rank_genes_groups"]["params"]["reference"]
-
-    scores = DataFrame(
-        data=adata.uns[key]["scores"][column], index=adata.uns[key]["names"][column]
-    )
-    lfc = DataFrame(
-        data=adata.uns[key]["logfoldchanges"][column],
-        index=adata.uns[key]["names"][column],
-    )
-    pvals = DataFrame(
-        data=adata.uns[key]["pvals"][column], index=adata.uns[key]["names"][column]
-    )
-    padj = DataFrame(
-        data=adata.uns[key]["pvals_adj"][column], index=adata.uns[key]["names"][column]
+    arrays, keep = viewDEres(
+        adata, column=column, remove_mito_ribo=remove_mito_ribo, key=key
     )
-    try:
-        pts = DataFrame(
-            data=adata.uns[key]["pts"][column], index=adata.uns[key]["names"][column]
-        )
-        ptsx = DataFrame(
-            data=adata.uns[key]["pts_" + reference][column],
-            index=adata.uns[key]["names"][column],
-        )
-    except:
-        pass
-    scores = scores.loc[scores.index.dropna()]
-    lfc = lfc.loc[lfc.index.dropna()]
-    pvals = pvals.loc[pvals.index.dropna()]
-    padj = padj.loc[padj.index.dropna()]
-    try:
-        pts = pts.loc[pts.index.dropna()]
-        ptsx = ptsx.loc[ptsx.index.dropna()]
-    except:
-        pass
-    try:
-        dfs = [scores, lfc, pvals, padj, pts, ptsx]
-    except:
-        dfs = [scores, lfc, pvals, padj]
-    try:
-        df_final = functools.reduce(
-            lambda left, right: pd.merge(
-                left, right, left_index=True, right_index=True
-            ),
-            dfs,
-        )
-    except:
-        df_final = pd.concat(dfs, axis=1)
-    try:
-        df_final.columns = [
-            "scores",
-            "logfoldchanges",
-            "pvals",
-            "pvals_adj",
-            "pts" + "_" + column,
-            "pts_" + reference,
-        ]
-    except:
-        df_final.columns = ["scores", "logfoldchanges", "pvals", "pvals_adj"]
-    if remove_mito_ribo:
-        df_final = df_final[
-            ~df_final.index.isin(
-                list(df_final.filter(regex="^RPL|^RPS|^MRPS|^MRPL|^MT-", axis=0).index)
-            )
-        ]
-        df_final = df_final[
-            ~df_final.index.isin(
-                list(df_final.filter(regex="^Rpl|^Rps|^Mrps|^Mrpl|^mt-", axis=0).index)
-            )
-        ]
-
-    return df_final
+    return _DEres_frame(arrays, keep)
 
 
-def vmax(adata: AnnData, genes: Union[List, str], pct: float) -> List:
+def vmax(
+    adata: AnnData,
+    genes: Union[List, str],
+    pct: float,
+    pool: Optional[SharedPool] = None,
+) -> List:
     """
     Extract the maximum expression value from list of genes in `AnnData` at the specified `pct`.
 
@@ -187,6 +249,8 @@ def vmax(adata: AnnData, genes: Union[List, str], pct: float) -> List:
         gene(s) to query from `AnnData` object.
     pct : float
         percentage to cut-off and return.
+    pool : Optional[SharedPool], optional
+        pool sharing `.raw` to compute the genes in parallel.
 
     Returns
     -------
@@ -195,19 +259,29 @@ def vmax(adata: AnnData, genes: Union[List, str], pct: float) -> List:
     """
     if type(genes) is not list:
         genes = [genes]
-    vm = []
+    idx = []
     for g in genes:
         try:
-            idx = adata.raw.var.index.get_loc(g)
+            idx.append(adata.raw.var.index.get_loc(g))
         except:
-            idx = adata.var.index.get_loc(g)
-        vm.append(
-            math.ceil(np.quantile(adata.raw.X[:, idx].toarray(), pct) * 100.0) / 100.0
-        )
-    return vm
+            idx.append(adata.var.index.get_loc(g))
+    if pool is not None:
+        pool.check(use_raw=True)
+        values = pool.quantiles(idx, pct)
+    elif scipy.sparse.issparse(adata.raw.X) or isinstance(adata.raw.X, np.ndarray):
+        values = column_quantiles(csc_view(adata.raw.X), idx, pct)
+    else:
+        # dask or backed
+        values = [np.quantile(_gene_column(adata.raw.X, i), pct) for i in idx]
+    return [math.ceil(v * 100.0) / 100.0 for v in values]
 
 
-def vmin(adata: AnnData, genes: Union[List, str], pct: float) -> List:
+def vmin(
+    adata: AnnData,
+    genes: Union[List, str],
+    pct: float,
+    pool: Optional[SharedPool] = None,
+) -> List:
     """
     Extract the minimum expression value from list of genes in `AnnData` at the specified `pct`.
 
@@ -219,6 +293,8 @@ def vmin(adata: AnnData, genes: Union[List, str], pct: float) -> List:
         gene(s) to query from `AnnData` object.
     pct : float
         percentage to cut-off and return.
+    pool : Optional[SharedPool], optional
+        pool sharing `.raw` to compute the genes in parallel.
 
     Returns
     -------
@@ -227,49 +303,37 @@ def vmin(adata: AnnData, genes: Union[List, str], pct: float) -> List:
     """
     if type(genes) is not list:
         genes = [genes]
-    vm = []
+    idx = []
     for g in genes:
         try:
-            idx = adata.raw.var.index.get_loc(g)
+            idx.append(adata.raw.var.index.get_loc(g))
         except:
-            idx = adata.var.index.get_loc(g)
-        vm.append(
-            math.ceil(np.quantile(adata.raw.X[:, idx].toarray(), 1 - pct) * 100.0)
-            / 100.0
-        )
-    return vm
+            idx.append(adata.var.index.get_loc(g))
+    if pool is not None:
+        pool.check(use_raw=True)
+        values = pool.quantiles(idx, 1 - pct)
+    elif scipy.sparse.issparse(adata.raw.X) or isinstance(adata.raw.X, np.ndarray):
+        values = column_quantiles(csc_view(adata.raw.X), idx, 1 - pct)
+    else:
+        # dask or backed
+        values = [np.quantile(_gene_column(adata.raw.X, i), 1 - pct) for i in idx]
+    return [math.ceil(v * 100.0) / 100.0 for v in values]
 
 
-def cell_cycle_scoring(adata: AnnData, human: bool = False):
+def _cell_cycle_genes(human: bool = False) -> Tuple[List[str], List[str]]:
     """
-    Run cell cycle scoring on `AnnData` object.
+    Return the S phase and G2/M phase marker genes.
 
     Parameters
     ----------
-    adata : AnnData
-        input `AnnData` object.
     human : bool, optional
         whether the data is human or not (mouse).
 
+    Returns
+    -------
+    Tuple[List[str], List[str]]
+        S phase and G2/M phase genes.
     """
-    # cell cycle scoring
-    adata_cc = adata.copy()
-    if adata_cc.raw is not None:
-        adata_cc = adata_cc.raw.to_adata()
-
-    if float(np.max(adata_cc.X)).is_integer():
-        # raw integer counts
-        sc.pp.normalize_total(adata_cc, target_sum=1e4)
-        sc.pp.log1p(adata_cc)
-        sc.pp.scale(adata_cc)
-    elif np.min(adata_cc.X) == 0:
-        if "log1p" not in adata_cc.uns:
-            sc.pp.log1p(adata_cc)
-        # not scaled
-        sc.pp.scale(adata_cc)
-    else:
-        raise ValueError("Please provide either raw integer or normalised data.")
-
     if not human:
         s_genes = [
             "Mcm5",
@@ -468,11 +532,384 @@ def cell_cycle_scoring(adata: AnnData, human: bool = False):
             "CBX5",
             "CENPA",
         ]
+    return s_genes, g2m_genes
+
+
+def _data_state(adata: AnnData) -> str:
+    """
+    Return the state of the data used for scoring, detecting it only once.
+
+    The state of `.raw` (or `.X` if there is no `.raw`) is recorded in
+    `.uns["kttools"]["data_state"]` with a digest of the matrix (shape,
+    number of stored values and a sample of the values) and of the
+    `.uns["log1p"]` flag, and reused for as long as those still match. In
+    place transformations such as `sc.pp.normalize_total` or `sc.pp.log1p`
+    change the sampled values, so they trigger a new detection.
+
+    Parameters
+    ----------
+    adata : AnnData
+        input `AnnData` object.
+
+    Returns
+    -------
+    str
+        one of `counts`, `normalized`, `log1p` or `scaled`.
+    """
+    # `raw.to_adata()` keeps `.uns`, so the flag applies to `.raw` too
+    log1p = "log1p" in adata.uns
+    if adata.raw is not None:
+        source, X = "raw", adata.raw.X
+    else:
+        source, X = "X", adata.X
+    h = hashlib.blake2b(digest_size=16)
+    _fingerprint_matrix(h, X)
+    h.update(str(log1p).encode())
+    signature = h.hexdigest()
+    record = adata.uns.get("kttools", {}).get("data_state", {}).get(source)
+    if record is not None and record["signature"] == signature:
+        return record["state"]
+    state = _detect_data_state(X, log1p=log1p)
+    adata.uns.setdefault("kttools", {}).setdefault("data_state", {})[source] = {
+        "state": state,
+        "signature": signature,
+    }
+    return state
+
+
+def _log_normalized(X, state: str, target_sum: float = 1e4):
+    """
+    Bring a matrix to log1p of normalised counts, keeping it sparse.
+
+    Parameters
+    ----------
+    X
+        sparse or dense matrix of all genes.
+    state : str
+        state of `X`, one of `counts`, `normalized` or `log1p`.
+    target_sum : float, optional
+        total counts per cell after normalisation.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix or np.ndarray
+        log1p transformed normalised values.
+    """
+    if scipy.sparse.issparse(X):
+        X = scipy.sparse.csr_matrix(X, dtype=np.float64, copy=True)
+    else:
+        X = np.array(X, dtype=np.float64)
+    if state == "counts":
+        totals = np.asarray(X.sum(axis=1)).ravel()
+        factors = np.divide(
+            target_sum, totals, out=np.zeros_like(totals), where=totals > 0
+        )
+        if scipy.sparse.issparse(X):
+            X.data *= np.repeat(factors, np.diff(X.indptr))
+        else:
+            X *= factors[:, None]
+    if state in ("counts", "normalized"):
+        if scipy.sparse.issparse(X):
+            np.log1p(X.data, out=X.data)
+        else:
+            np.log1p(X, out=X)
+    return X
+
+
+def _control_genes(
+    means: pd.Series, gene_list: List[str], ctrl_size: int, n_bins: int, seed: int
+) -> List[str]:
+    """
+    Pick control genes with expression matched to a gene list, as in Seurat.
+
+    Genes are binned by their mean expression and, for every bin holding a
+    gene of `gene_list`, `ctrl_size` other genes are drawn from that bin.
+
+    Parameters
+    ----------
+    means : pd.Series
+        mean expression of every gene.
+    gene_list : List[str]
+        genes to match.
+    ctrl_size : int
+        number of control genes drawn per bin.
+    n_bins : int
+        number of expression bins.
+    seed : int
+        random seed.
+
+    Returns
+    -------
+    List[str]
+        control genes.
+    """
+    rng = np.random.RandomState(seed)
+    bins = pd.cut(means.rank(method="min"), n_bins, labels=False)
+    control = set()
+    for b in np.unique(bins[gene_list]):
+        pool = bins.index[(bins == b) & ~bins.index.isin(gene_list)]
+        control.update(rng.choice(pool, min(ctrl_size, len(pool)), replace=False))
+    return sorted(control)
+
+
+def _cell_cycle_reference(
+    X,
+    var_names: pd.Index,
+    state: str,
+    s_genes: List[str],
+    g2m_genes: List[str],
+    n_bins: int = 25,
+    seed: int = 0,
+) -> Dict:
+    """
+    Fit the parameters of cell cycle scoring.
+
+    Parameters
+    ----------
+    X
+        sparse or dense matrix of all genes.
+    var_names : pd.Index
+        gene names of `X`.
+    state : str
+        state of `X`, one of `counts`, `normalized` or `log1p`.
+    s_genes : List[str]
+        S phase genes.
+    g2m_genes : List[str]
+        G2/M phase genes.
+    n_bins : int, optional
+        number of expression bins for picking control genes.
+    seed : int, optional
+        random seed for picking control genes.
+
+    Returns
+    -------
+    Dict
+        control genes and per-gene mean and standard deviation of the scored genes.
+    """
+    X = _log_normalized(X, state)
+    means = pd.Series(column_means(X), index=var_names)
+    s_genes = [g for g in s_genes if g in var_names]
+    g2m_genes = [g for g in g2m_genes if g in var_names]
+    ctrl_size = min(len(s_genes), len(g2m_genes))
+    s_control = _control_genes(means, s_genes, ctrl_size, n_bins, seed)
+    g2m_control = _control_genes(means, g2m_genes, ctrl_size, n_bins, seed)
+    genes = pd.Index(s_genes + g2m_genes + s_control + g2m_control).unique()
+    values = _dense(X[:, var_names.get_indexer(genes)])
+    # unit variance with the unbiased estimate, as `sc.pp.scale`
+    std = values.std(axis=0, ddof=1)
+    std[std == 0] = 1
+    return {
+        "state": state,
+        "genes": np.asarray(genes, dtype=object),
+        "mean": values.mean(axis=0),
+        "std": std,
+        "s_genes": np.asarray(s_genes, dtype=object),
+        "g2m_genes": np.asarray(g2m_genes, dtype=object),
+        "s_control": np.asarray(s_control, dtype=object),
+        "g2m_control": np.asarray(g2m_control, dtype=object),
+        "n_bins": n_bins,
+        "seed": seed,
+    }
+
+
+def _score_cell_cycle(X, var_names: pd.Index, reference: Mapping) -> DataFrame:
+    """
+    Score cells against fitted cell cycle parameters.
+
+    Only the scored genes of the given cells are scaled, so the cost is
+    proportional to the number of cells.
+
+    Parameters
+    ----------
+    X
+        sparse or dense matrix of all genes of the cells to score.
+    var_names : pd.Index
+        gene names of `X`.
+    reference : Mapping
+        parameters from `_cell_cycle_reference`.
+
+    Returns
+    -------
+    DataFrame
+        `S_score`, `G2M_score` and `phase` of each cell.
+    """
+    genes = pd.Index(reference["genes"])
+    idx = var_names.get_indexer(genes)
+    if (idx < 0).any():
+        raise KeyError(
+            "Genes of the cell cycle reference not found: {}".format(
+                list(genes[idx < 0])
+            )
+        )
+    X = _log_normalized(X, reference["state"])
+    scaled = pd.DataFrame(
+        (_dense(X[:, idx]) - reference["mean"]) / reference["std"], columns=genes
+    )
+    scores = pd.DataFrame(
+        {
+            "S_score": scaled[list(reference["s_genes"])].mean(axis=1)
+            - scaled[list(reference["s_control"])].mean(axis=1),
+            "G2M_score": scaled[list(reference["g2m_genes"])].mean(axis=1)
+            - scaled[list(reference["g2m_control"])].mean(axis=1),
+        }
+    )
+    # same phase assignment as `sc.tl.score_genes_cell_cycle`
+    phase = pd.Series("S", index=scores.index)
+    phase[scores["G2M_score"] > scores["S_score"]] = "G2M"
+    phase[np.all(scores < 0, axis=1)] = "G1"
+    scores["phase"] = phase
+    return scores
+
+
+def cell_cycle_scoring(
+    adata: AnnData,
+    human: bool = False,
+    use_cache: bool = False,
+    reference: Optional[Union[AnnData, Mapping]] = None,
+    store_reference: bool = False,
+):
+    """
+    Run cell cycle scoring on `AnnData` object.
+
+    Parameters
+    ----------
+    adata : AnnData
+        input `AnnData` object.
+    human : bool, optional
+        whether the data is human or not (mouse).
+    use_cache : bool, optional
+        whether to restore the scores from the on-disk result cache if the
+        input is unchanged, and to store them there otherwise.
+    reference : Optional[Union[AnnData, Mapping]], optional
+        `AnnData` scored with `store_reference=True`, or its
+        `.uns["cell_cycle_reference"]`. Cells are then scored against the
+        stored scaling parameters and control genes, and only cells without
+        an `S_score` yet (e.g. newly appended cells) are scored.
+    store_reference : bool, optional
+        whether to fit the scaling parameters and control genes on all cells
+        and store them in `.uns["cell_cycle_reference"]`, for scoring new
+        cells later with `reference`.
+
+    """
+    s_genes, g2m_genes = _cell_cycle_genes(human)
+    if adata.raw is not None:
+        X, var_names = adata.raw.X, adata.raw.var_names
+    else:
+        X, var_names = adata.X, adata.var_names
+    if reference is not None:
+        if isinstance(reference, AnnData):
+            reference = reference.uns[CELL_CYCLE_REFERENCE]
+        if "S_score" in adata.obs:
+            rows = np.flatnonzero(adata.obs["S_score"].isna())
+        else:
+            rows = np.arange(adata.n_obs)
+        scores = _score_cell_cycle(X[rows], var_names, reference)
+        for x in ["S_score", "G2M_score", "phase"]:
+            if x in adata.obs:
+                values = np.array(adata.obs[x], dtype=object if x == "phase" else float)
+            else:
+                values = np.full(adata.n_obs, None if x == "phase" else np.nan)
+            values[rows] = scores[x].to_numpy()
+            adata.obs[x] = values
+        return
+    if store_reference:
+        state = _data_state(adata)
+        if state == "scaled":
+            raise ValueError("Please provide either raw integer or normalised data.")
+        reference = _cell_cycle_reference(X, var_names, state, s_genes, g2m_genes)
+        adata.uns[CELL_CYCLE_REFERENCE] = reference
+        scores = _score_cell_cycle(X, var_names, reference)
+        for x in ["S_score", "G2M_score", "phase"]:
+            adata.obs[x] = scores[x].to_numpy()
+        return
+    if use_cache:
+        digest = _fingerprint_cell_cycle(adata, s_genes, g2m_genes)
+        cached = _cache_load("cell_cycle_scoring", digest)
+        if cached is not None:
+            for x in ["S_score", "G2M_score", "phase"]:
+                adata.obs[x] = cached[x]
+            return
+
+    # cell cycle scoring
+    state = _data_state(adata)
+    if state == "scaled":
+        raise ValueError("Please provide either raw integer or normalised data.")
+    if adata.raw is not None:
+        adata_cc = adata.raw.to_adata()
+    else:
+        adata_cc = adata.copy()
+
+    if state == "counts":
+        # raw integer counts
+        sc.pp.normalize_total(adata_cc, target_sum=1e4)
+        sc.pp.log1p(adata_cc)
+        sc.pp.scale(adata_cc)
+    else:
+        if state == "normalized":
+            sc.pp.log1p(adata_cc)
+        # not scaled
+        sc.pp.scale(adata_cc)
+
     sc.tl.score_genes_cell_cycle(
         adata_cc, s_genes=s_genes, g2m_genes=g2m_genes, use_raw=False
     )
     for x in ["S_score", "G2M_score", "phase"]:
         adata.obs[x] = adata_cc.obs[x]
+    if use_cache:
+        _cache_save(
+            "cell_cycle_scoring",
+            digest,
+            adata_cc.obs[["S_score", "G2M_score", "phase"]],
+        )
+
+
+def _combine_categories(obs: DataFrame, keys: List[str], sep: str) -> pd.Categorical:
+    """
+    Build the combined categorical of several `.obs` columns from packed codes.
+
+    Parameters
+    ----------
+    obs : DataFrame
+        `.obs` of an `AnnData` object.
+    keys : List[str]
+        column names to combine, in order.
+    sep : str
+        The separator to combine the names.
+
+    Returns
+    -------
+    pd.Categorical
+        combined categorical with only the observed combinations as categories.
+    """
+    codes, levels = _packed_codes(obs, keys)
+    names = pd.Series(levels[0].astype(str), dtype=object)
+    for lv in levels[1:]:
+        names = names + sep + lv.astype(str)
+    # different combinations can join to the same name e.g. a_b + c and a + b_c
+    uniq_codes, uniq_names = pd.factorize(names)
+    codes[codes >= 0] = uniq_codes[codes[codes >= 0]]
+    return pd.Categorical.from_codes(codes, categories=uniq_names)
+
+
+def combine_categories(
+    adata: AnnData, keys: List[str], sep: str = "_", key_added: Optional[str] = None
+) -> None:
+    """Combine any number of categories in place, respecting the order of the concatenation.
+
+    Parameters
+    ----------
+    adata : AnnData
+        Input anndata object.
+    keys : List[str]
+        Column names of the categories to combine.
+    sep : str, optional
+        The separator to combine the names.
+    key_added : Optional[str], optional
+        Column name for the combined category. Defaults to `keys` joined by `sep`.
+    """
+    if key_added is None:
+        key_added = sep.join(keys)
+    adata.obs[key_added] = _combine_categories(adata.obs, keys, sep)
 
 
 def combine_two_categories(adata: AnnData, A: str, B: str, sep: str = "_") -> None:
@@ -490,18 +927,122 @@ def combine_two_categories(adata: AnnData, A: str, B: str, sep: str = "_") -> No
         The separator to combine the names.
     """
     comb_cat = A + sep + B
-    adata.obs[comb_cat] = [a + "_" + b for a, b in zip(adata.obs[A], adata.obs[B])]
     adata.obs[A] = adata.obs[A].astype("category")
     adata.obs[B] = adata.obs[B].astype("category")
-    a_cat = adata.obs[A].cat.categories
-    b_cat = adata.obs[B].cat.categories
-    cats = []
-    for a in a_cat:
-        for b in b_cat:
-            cats.append(a + "_" + b)
-    adata.obs[comb_cat] = adata.obs[comb_cat].astype("category")
-    adata.obs[comb_cat] = adata.obs[comb_cat].cat.reorder_categories(
-        [c for c in cats if c in adata.obs[comb_cat].cat.categories]
+    adata.obs[comb_cat] = _combine_categories(adata.obs, [A, B], "_")
+
+
+def _dotplot_2obs_stats(
+    adata: AnnData,
+    genes: List[str],
+    x_axis: str,
+    y_axis: str,
+    x_order: Optional[List] = None,
+    y_order: Optional[List] = None,
+    use_raw: bool = True,
+    fill_na: bool = True,
+    pool: Optional[SharedPool] = None,
+) -> Tuple[Dict[str, DataFrame], Dict[str, DataFrame]]:
+    """
+    Compute the dot size and dot colour tables for many genes in one pass.
+
+    Parameters
+    ----------
+    adata : AnnData
+        input `AnnData` object.
+    genes : List[str]
+        genes to compute the tables for.
+    x_axis : str
+        column in `.obs` for the x axis.
+    y_axis : str
+        column in `.obs` for the y axis.
+    x_order : Optional[List], optional
+        order of the x axis categories.
+    y_order : Optional[List], optional
+        order of the y axis categories.
+    use_raw : bool, optional
+        whether to use `.raw` or `.X`.
+    fill_na : bool, optional
+        whether to fill absent obs combinations with zeroes.
+    pool : Optional[SharedPool], optional
+        pool sharing the matrix and both `.obs` columns to aggregate in parallel.
+
+    Returns
+    -------
+    Tuple[Dict[str, DataFrame], Dict[str, DataFrame]]
+        dot size and dot colour `DataFrame` for each gene.
+    """
+    if pool is not None:
+        pool.check(use_raw=use_raw, obs_keys=[y_axis, x_axis])
+        res = pool.aggregate([y_axis, x_axis], genes, stats=("mean", "fraction"))
+    else:
+        res = aggregate(
+            adata, [y_axis, x_axis], genes, stats=("mean", "fraction"), use_raw=use_raw
+        )
+    y_cats = np.unique(adata.obs[y_axis])
+    x_cats = np.unique(adata.obs[x_axis])
+    dot_size_dfs, dot_color_dfs = {}, {}
+    for gene in genes:
+        # absent combinations come out as NaN
+        size, color = (
+            res[stat][gene].unstack(x_axis).reindex(index=y_cats, columns=x_cats)
+            for stat in ("fraction", "mean")
+        )
+        size.index.name, size.columns.name = None, None
+        color.index.name, color.columns.name = None, None
+        # reorder the groups if specified
+        if x_order is not None:
+            size, color = size[x_order], color[x_order]
+        if y_order is not None:
+            size, color = size.loc[y_order, :], color.loc[y_order, :]
+        if fill_na:
+            size, color = size.fillna(0), color.fillna(0)
+        dot_size_dfs[gene], dot_color_dfs[gene] = size, color
+    return dot_size_dfs, dot_color_dfs
+
+
+def _make_dotplot(
+    dot_size_df: DataFrame, dot_color_df: DataFrame, y_axis: str, title: str, **kwargs
+) -> DotPlot:
+    """
+    Wrap precomputed dot size and colour tables into a `DotPlot`.
+
+    Parameters
+    ----------
+    dot_size_df : DataFrame
+        fraction of cells expressing the gene (y categories x x categories).
+    dot_color_df : DataFrame
+        mean expression of the gene (y categories x x categories).
+    y_axis : str
+        name of the grouping variable.
+    title : str
+        plot title.
+    **kwargs
+        passed to `DotPlot`.
+
+    Returns
+    -------
+    DotPlot
+        `DotPlot` instance.
+    """
+    # in order to actually plot this, we need to make a dummy anndata object
+    # just how DotPlot() is wired internally
+    bdata = AnnData(np.zeros(dot_size_df.shape))
+    bdata.var_names = dot_size_df.columns
+    # this needs to be turned to a list or it whines about a conflict later
+    bdata.obs_names = list(dot_size_df.index)
+    # the grouping variable needs to be present in the dummy object
+    # its existence is checked, it actually does nothing when we insert the dot sizes
+    bdata.obs[y_axis] = dot_size_df.index
+    # actually make the dotplot, with the best colour scheme :P
+    return DotPlot(
+        bdata,
+        dot_size_df.columns,
+        y_axis,
+        dot_size_df=dot_size_df,
+        dot_color_df=dot_color_df,
+        title=title,
+        **kwargs,
     )
 
 
@@ -515,7 +1056,7 @@ def dotplot_2obs(
     use_raw=True,
     fill_na=True,
     show_plot=True,
-    **kwargs
+    **kwargs,
 ):
     """
     A function that extracts the expression for a provided gene,
@@ -528,64 +1069,259 @@ def dotplot_2obs(
 
     Thanks kp9!
     """
-    # prepare dfs with dot sizes and colours
-    # start off by making a helper df with all the info
-    obs_tidy_master = adata.obs[[y_axis, x_axis]].set_index(y_axis)
-    # add gene expression
-    if use_raw:
-        if scipy.sparse.issparse(adata.raw.X):
-            obs_tidy_master[gene] = adata.raw[:, gene].X.todense()
-        else:
-            obs_tidy_master[gene] = np.array(adata.raw[:, gene].X)
-    else:
-        if scipy.sparse.issparse(adata.X):
-            obs_tidy_master[gene] = adata[:, gene].X.todense()
-        else:
-            obs_tidy_master[gene] = np.array(adata[:, gene].X)
-    # this is where our computed values will go
-    dot_size_df = pd.DataFrame(
-        0,
-        index=np.unique(obs_tidy_master.index),
-        columns=np.unique(obs_tidy_master[x_axis]),
-    )
-    # reorder the groups if specified
-    if x_order is not None:
-        dot_size_df = dot_size_df[x_order]
-    if y_order is not None:
-        dot_size_df = dot_size_df.loc[y_order, :]
-    dot_color_df = dot_size_df.copy()
     # compute the sizes and colors, replicating the logic found within DotPlot()
-    for cat in dot_size_df.columns:
-        obs_tidy = obs_tidy_master.loc[obs_tidy_master[x_axis] == cat, gene]
-        obs_bool = obs_tidy > 0
-        dot_color_df[cat] = obs_tidy.groupby(level=0).mean().fillna(0)
-        dot_size_df[cat] = (
-            obs_bool.groupby(level=0).sum() / obs_bool.groupby(level=0).count()
-        )
-    # some combinations may be absent, and there will be NaNs there, and this sometimes kills the plot
-    # fill with zeroes if specified
-    if fill_na:
-        dot_color_df.fillna(0, inplace=True)
-        dot_size_df.fillna(0, inplace=True)
-    # in order to actually plot this, we need to make a dummy anndata object
-    # just how DotPlot() is wired internally
-    bdata = AnnData(np.zeros(dot_size_df.shape))
-    bdata.var_names = dot_size_df.columns
-    # this needs to be turned to a list or it whines about a conflict later
-    bdata.obs_names = list(dot_size_df.index)
-    # the grouping variable needs to be present in the dummy object
-    # its existence is checked, it actually does nothing when we insert the dot sizes
-    bdata.obs[y_axis] = dot_size_df.index
-    # actually make the dotplot, with the best colour scheme :P
-    dp = DotPlot(
-        bdata,
-        dot_size_df.columns,
+    dot_size_dfs, dot_color_dfs = _dotplot_2obs_stats(
+        adata,
+        [gene],
+        x_axis,
         y_axis,
-        dot_size_df=dot_size_df,
-        dot_color_df=dot_color_df,
-        title=gene,
-        **kwargs,
+        x_order=x_order,
+        y_order=y_order,
+        use_raw=use_raw,
+        fill_na=fill_na,
+    )
+    dp = _make_dotplot(
+        dot_size_dfs[gene], dot_color_dfs[gene], y_axis, title=gene, **kwargs
     )
     if show_plot:
         dp.show()
     return dp
+
+
+def _use_agg() -> None:
+    """Select the headless Agg backend in a worker process."""
+    matplotlib.use("Agg")
+
+
+def _detach_figure(fig: Figure) -> Figure:
+    """
+    Release a figure from pyplot and attach it to an Agg canvas.
+
+    The figure is not shown by interactive or inline backends afterwards, and
+    the session backend is left unchanged.
+
+    Parameters
+    ----------
+    fig : Figure
+        figure made through pyplot.
+
+    Returns
+    -------
+    Figure
+        the same figure, on an Agg canvas.
+    """
+    plt.close(fig)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _render_dotplot(
+    dot_size_df: DataFrame,
+    dot_color_df: DataFrame,
+    y_axis: str,
+    title: str,
+    filename: str,
+    style: Dict,
+    kwargs: Dict,
+) -> str:
+    """
+    Render one dotplot headlessly to a file.
+
+    Parameters
+    ----------
+    dot_size_df : DataFrame
+        fraction of cells expressing the gene.
+    dot_color_df : DataFrame
+        mean expression of the gene.
+    y_axis : str
+        name of the grouping variable.
+    title : str
+        plot title.
+    filename : str
+        output file.
+    style : Dict
+        passed to `DotPlot.style`.
+    kwargs : Dict
+        passed to `DotPlot`.
+
+    Returns
+    -------
+    str
+        the output file.
+    """
+    dp = _make_dotplot(dot_size_df, dot_color_df, y_axis, title=title, **kwargs)
+    dp.style(**style)
+    dp.make_figure()
+    _detach_figure(dp.fig).savefig(filename, bbox_inches="tight")
+    return filename
+
+
+def dotplot_2obs_batch(
+    adata: AnnData,
+    genes: List[str],
+    x_axis: str,
+    y_axis: str,
+    filename: str,
+    x_order: Optional[List] = None,
+    y_order: Optional[List] = None,
+    use_raw: bool = True,
+    fill_na: bool = True,
+    shared_scale: bool = True,
+    fmt: str = "png",
+    n_jobs: int = 1,
+    pool: Optional[SharedPool] = None,
+    **kwargs,
+) -> List[str]:
+    """
+    Render `dotplot_2obs` for many genes into a multi-page PDF or a directory of images.
+
+    The mean expression and fraction of expressing cells are computed for all
+    genes in one pass, after which each gene is rendered headlessly.
+
+    Parameters
+    ----------
+    adata : AnnData
+        input `AnnData` object.
+    genes : List[str]
+        genes to plot, one per page/image.
+    x_axis : str
+        column in `.obs` for the x axis.
+    y_axis : str
+        column in `.obs` for the y axis.
+    filename : str
+        if it ends with `.pdf`, all plots are written as pages of one PDF.
+        Otherwise, it is treated as a directory and one image per gene is saved into it.
+    x_order : Optional[List], optional
+        order of the x axis categories.
+    y_order : Optional[List], optional
+        order of the y axis categories.
+    use_raw : bool, optional
+        whether to use `.raw` or `.X`.
+    fill_na : bool, optional
+        whether to fill absent obs combinations with zeroes.
+    shared_scale : bool, optional
+        whether to use the same colour limits and dot size scale for all genes.
+    fmt : str, optional
+        image format when writing to a directory.
+    n_jobs : int, optional
+        number of worker processes used to render images into a directory.
+        A multi-page PDF is written by a single process.
+    pool : Optional[SharedPool], optional
+        pool sharing the matrix and `x_axis`/`y_axis` columns. If given, the
+        genes are aggregated and the images rendered in its workers, and
+        `n_jobs` is ignored.
+    **kwargs
+        passed to `DotPlot`.
+
+    Returns
+    -------
+    List[str]
+        List of files written.
+    """
+    if type(genes) is not list:
+        genes = [genes]
+    executor = None
+    if pool is None and n_jobs > 1 and not filename.endswith(".pdf"):
+        # before the statistics, which may start numba threads
+        executor = _start_executor(n_jobs, initializer=_use_agg)
+    try:
+        return _dotplot_2obs_batch(
+            adata,
+            genes,
+            x_axis,
+            y_axis,
+            filename,
+            x_order=x_order,
+            y_order=y_order,
+            use_raw=use_raw,
+            fill_na=fill_na,
+            shared_scale=shared_scale,
+            fmt=fmt,
+            pool=pool,
+            executor=executor,
+            **kwargs,
+        )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def _dotplot_2obs_batch(
+    adata: AnnData,
+    genes: List[str],
+    x_axis: str,
+    y_axis: str,
+    filename: str,
+    x_order: Optional[List],
+    y_order: Optional[List],
+    use_raw: bool,
+    fill_na: bool,
+    shared_scale: bool,
+    fmt: str,
+    pool: Optional[SharedPool],
+    executor: Optional[ProcessPoolExecutor],
+    **kwargs,
+) -> List[str]:
+    """Body of `dotplot_2obs_batch`, rendering in `pool` or `executor` if given."""
+    dot_size_dfs, dot_color_dfs = _dotplot_2obs_stats(
+        adata,
+        genes,
+        x_axis,
+        y_axis,
+        x_order=x_order,
+        y_order=y_order,
+        use_raw=use_raw,
+        fill_na=fill_na,
+        pool=pool,
+    )
+    style = {}
+    if shared_scale:
+        kwargs.setdefault(
+            "vmin", np.nanmin([np.nanmin(df.values) for df in dot_color_dfs.values()])
+        )
+        kwargs.setdefault(
+            "vmax", np.nanmax([np.nanmax(df.values) for df in dot_color_dfs.values()])
+        )
+        dot_max = np.nanmax([np.nanmax(df.values) for df in dot_size_dfs.values()])
+        # same rounding as DotPlot uses for a single plot
+        style["dot_max"] = np.ceil(dot_max * 10) / 10 if dot_max > 0 else None
+        style["dot_min"] = 0
+
+    if filename.endswith(".pdf"):
+        with PdfPages(filename) as pdf:
+            for gene in genes:
+                dp = _make_dotplot(
+                    dot_size_dfs[gene],
+                    dot_color_dfs[gene],
+                    y_axis,
+                    title=gene,
+                    **kwargs,
+                )
+                dp.style(**style)
+                dp.make_figure()
+                pdf.savefig(_detach_figure(dp.fig), bbox_inches="tight")
+        return [filename]
+
+    os.makedirs(filename, exist_ok=True)
+    outfiles = [
+        os.path.join(filename, gene.replace(os.sep, "_") + "." + fmt) for gene in genes
+    ]
+    jobs = [
+        (
+            dot_size_dfs[gene],
+            dot_color_dfs[gene],
+            y_axis,
+            gene,
+            outfile,
+            style,
+            kwargs,
+        )
+        for gene, outfile in zip(genes, outfiles)
+    ]
+    if pool is not None:
+        futures = [pool.submit(_render_dotplot, *job) for job in jobs]
+        return [f.result() for f in futures]
+    if executor is None:
+        return [_render_dotplot(*job) for job in jobs]
+    futures = [executor.submit(_render_dotplot, *job) for job in jobs]
+    return [f.result() for f in futures]
@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+# @Author: Kelvin
+# @Date:   2026-10-19 15:36:52
+# @Last Modified by:   Kelvin
+# @Last Modified time: 2026-10-19 15:36:52
+"""Worker pool sharing an expression matrix through shared memory."""
+import matplotlib
+import multiprocessing
+import scipy.sparse
+
+import numpy as np
+import pandas as pd
+
+from anndata import AnnData
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Union
+
+from ._aggregate import aggregate
+from ._kernels import _fork_unsafe, column_quantiles
+from ._utils import _get_matrix, _is_dask
+
+# buffers attached by a worker process, kept alive for its lifetime
+_ATTACHED = {}
+
+
+def _mp_context() -> Optional[multiprocessing.context.BaseContext]:
+    """
+    Return the start method for worker processes.
+
+    The platform default is kept, unless it is `fork` and numba has already
+    started its TBB thread pool in this process: forking then hangs the parent
+    at exit, so workers are started fresh instead. Those workers can only run
+    functions importable from a module, not ones defined in `__main__`.
+
+    Returns
+    -------
+    Optional[multiprocessing.context.BaseContext]
+        None for the default, or a `forkserver` (`spawn` where unavailable)
+        context.
+    """
+    method = (
+        multiprocessing.get_start_method(allow_none=True)
+        or multiprocessing.get_all_start_methods()[0]
+    )
+    if method != "fork" or not _fork_unsafe():
+        return None
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context(
+        "forkserver" if "forkserver" in methods else "spawn"
+    )
+
+
+def _start_executor(
+    n_jobs: int, initializer: Optional[Callable] = None, initargs: tuple = ()
+) -> ProcessPoolExecutor:
+    """
+    Create a process pool and start all its workers.
+
+    Forked workers are all started by the first task, so starting them right
+    away keeps them clear of numba threads started later in this process.
+
+    Parameters
+    ----------
+    n_jobs : int
+        number of worker processes.
+    initializer : Optional[Callable], optional
+        function run by each worker when it starts.
+    initargs : tuple, optional
+        arguments to `initializer`.
+
+    Returns
+    -------
+    ProcessPoolExecutor
+        the running pool.
+    """
+    executor = ProcessPoolExecutor(
+        max_workers=n_jobs,
+        mp_context=_mp_context(),
+        initializer=initializer,
+        initargs=initargs,
+    )
+    try:
+        executor.submit(int).result()
+    except BaseException:
+        executor.shutdown()
+        raise
+    return executor
+
+
+def _publish(x: np.ndarray) -> tuple:
+    """
+    Copy an array into a new shared memory block.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        array to publish.
+
+    Returns
+    -------
+    tuple
+        the shared memory block and the spec to attach to it.
+    """
+    x = np.ascontiguousarray(x)
+    shm = shared_memory.SharedMemory(create=True, size=max(x.nbytes, 1))
+    np.ndarray(x.shape, dtype=x.dtype, buffer=shm.buf)[...] = x
+    return shm, (shm.name, x.shape, x.dtype.str)
+
+
+def _attach(spec: tuple) -> np.ndarray:
+    """
+    Attach to a published array without copying.
+
+    Parameters
+    ----------
+    spec : tuple
+        name, shape and dtype of the array.
+
+    Returns
+    -------
+    np.ndarray
+        read-only view of the shared buffer.
+    """
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    _ATTACHED[name] = shm
+    x = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    x.flags.writeable = False
+    return x
+
+
+def _init_worker(spec: Dict) -> None:
+    """
+    Attach the shared matrix and `.obs` columns (pool initializer).
+
+    Parameters
+    ----------
+    spec : Dict
+        description of the published buffers.
+    """
+    # workers never show figures
+    matplotlib.use("Agg")
+    if spec["sparse"]:
+        data, indices, indptr = (_attach(s) for s in spec["X"])
+        X = scipy.sparse.csr_matrix((data, indices, indptr), shape=spec["shape"])
+    else:
+        X = _attach(spec["X"][0])
+    obs = pd.DataFrame(index=spec["obs_names"])
+    for key, (codes, categories) in spec["obs"].items():
+        codes = _attach(codes)
+        if categories is None:
+            obs[key] = codes
+        else:
+            obs[key] = pd.Categorical.from_codes(codes, categories)
+    _ATTACHED["adata"] = AnnData(X, obs=obs, var=pd.DataFrame(index=spec["var_names"]))
+
+
+def shared_adata() -> AnnData:
+    """
+    Return the `AnnData` shared with this worker.
+
+    Only valid inside a function run by `SharedPool.map`. `.X` is a read-only
+    view of the published matrix (`.raw.X` or a layer if the pool was built
+    from those), and `.obs` holds only the published columns.
+
+    Returns
+    -------
+    AnnData
+        the shared `AnnData`.
+    """
+    return _ATTACHED["adata"]
+
+
+def _call(func: Callable, item: Any) -> Any:
+    """
+    Run a function on the shared `AnnData` in a worker.
+
+    Parameters
+    ----------
+    func : Callable
+        function taking the shared `AnnData` and one item.
+    item : Any
+        item to process.
+
+    Returns
+    -------
+    Any
+        result of `func`.
+    """
+    return func(shared_adata(), item)
+
+
+def _quantiles(adata: AnnData, task: tuple) -> List[float]:
+    """
+    Compute a quantile of several genes of the shared matrix.
+
+    Parameters
+    ----------
+    adata : AnnData
+        shared `AnnData`.
+    task : tuple
+        column positions and quantile.
+
+    Returns
+    -------
+    List[float]
+        quantile of each gene.
+    """
+    idx, q = task
+    return column_quantiles(adata.X, idx, q).tolist()
+
+
+def _aggregate(adata: AnnData, task: tuple) -> Dict:
+    """
+    Aggregate several genes of the shared matrix.
+
+    Parameters
+    ----------
+    adata : AnnData
+        shared `AnnData`.
+    task : tuple
+        arguments to `aggregate`.
+
+    Returns
+    -------
+    Dict
+        result of `aggregate`.
+    """
+    keys, genes, stats, expression_cutoff = task
+    return aggregate(
+        adata, keys, genes, stats=stats, expression_cutoff=expression_cutoff
+    )
+
+
+class SharedPool:
+    """
+    Worker pool that shares an expression matrix instead of pickling it.
+
+    The CSR buffers (`data`, `indices` and `indptr`), or the dense array, and
+    the requested `.obs` columns are copied once into shared memory. Each
+    worker attaches to them without copying when it starts, so tasks only
+    send gene positions or names to the workers. Use as a context manager,
+    or call `close` to free the shared memory.
+
+    Parameters
+    ----------
+    adata : AnnData
+        input `AnnData` object. Backed or dask matrices are loaded once.
+    obs_keys : Optional[Union[List[str], str]], optional
+        columns in `.obs` to share, e.g. for grouping in `aggregate`.
+    use_raw : bool, optional
+        whether to share `.raw`.
+    layer : Optional[str], optional
+        layer to share instead of `.X`.
+    n_jobs : int, optional
+        number of worker processes.
+
+    Examples
+    --------
+    >>> with SharedPool(adata, obs_keys=["sample"], use_raw=True, n_jobs=8) as pool:
+    ...     vm = vmax(adata, genes, 0.99, pool=pool)
+    ...     dotplot_2obs_batch(adata, genes, "sample", "celltype", "plots", pool=pool)
+    """
+
+    def __init__(
+        self,
+        adata: AnnData,
+        obs_keys: Optional[Union[List[str], str]] = None,
+        use_raw: bool = False,
+        layer: Optional[str] = None,
+        n_jobs: int = 1,
+    ):
+        if obs_keys is None:
+            obs_keys = []
+        elif type(obs_keys) is not list:
+            obs_keys = [obs_keys]
+        X, var_names = _get_matrix(adata, layer, use_raw)
+        if _is_dask(X):
+            X = X.compute()
+        elif not (scipy.sparse.issparse(X) or isinstance(X, np.ndarray)):
+            # backed
+            X = X[:]
+        self.use_raw, self.layer, self.n_jobs = use_raw, layer, n_jobs
+        self.obs_keys, self.var_names = obs_keys, var_names
+        self._shm = []
+        try:
+            if scipy.sparse.issparse(X):
+                X = scipy.sparse.csr_matrix(X)
+                buffers = (X.data, X.indices, X.indptr)
+            else:
+                buffers = (np.asarray(X),)
+            spec = {
+                "sparse": scipy.sparse.issparse(X),
+                "shape": X.shape,
+                "X": [self._publish(b) for b in buffers],
+                "obs": {},
+                "obs_names": adata.obs_names,
+                "var_names": var_names,
+            }
+            for key in obs_keys:
+                col = adata.obs[key]
+                if not pd.api.types.is_numeric_dtype(col.dtype):
+                    col = col.astype("category")
+                    spec["obs"][key] = (
+                        self._publish(col.cat.codes.to_numpy()),
+                        col.cat.categories,
+                    )
+                else:
+                    spec["obs"][key] = (self._publish(col.to_numpy()), None)
+            self._executor = _start_executor(
+                n_jobs, initializer=_init_worker, initargs=(spec,)
+            )
+        except BaseException:
+            self._free()
+            raise
+
+    def _publish(self, x: np.ndarray) -> tuple:
+        """Publish an array and keep its shared memory block for cleanup."""
+        shm, spec = _publish(x)
+        self._shm.append(shm)
+        return spec
+
+    def _free(self) -> None:
+        """Release all shared memory blocks."""
+        for shm in self._shm:
+            shm.close()
+            shm.unlink()
+        self._shm = []
+
+    def map(self, func: Callable, items: Iterable) -> List:
+        """
+        Run `func(adata, item)` for each item in the workers.
+
+        Parameters
+        ----------
+        func : Callable
+            module-level function taking the shared `AnnData` and one item.
+        items : Iterable
+            items to process.
+
+        Returns
+        -------
+        List
+            results in the order of `items`.
+        """
+        futures = [self._executor.submit(_call, func, item) for item in items]
+        return [f.result() for f in futures]
+
+    def submit(self, func: Callable, *args, **kwargs):
+        """
+        Submit a function that does not need the shared `AnnData`.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            future of the result.
+        """
+        return self._executor.submit(func, *args, **kwargs)
+
+    def _split(self, items: Sequence) -> List[Sequence]:
+        """Split items into one batch per worker."""
+        n = max(min(self.n_jobs, len(items)), 1)
+        return [items[i::n] for i in range(n)]
+
+    def check(
+        self,
+        use_raw: bool = False,
+        layer: Optional[str] = None,
+        obs_keys: Sequence[str] = (),
+    ) -> None:
+        """
+        Check that the pool shares the data a function needs.
+
+        Parameters
+        ----------
+        use_raw : bool, optional
+            whether the function uses `.raw`.
+        layer : Optional[str], optional
+            layer the function uses instead of `.X`.
+        obs_keys : Sequence[str], optional
+            `.obs` columns the function uses.
+        """
+        if (use_raw, layer) != (self.use_raw, self.layer):
+            raise ValueError(
+                "The pool shares use_raw={}, layer={} but use_raw={}, layer={} "
+                "is needed.".format(self.use_raw, self.layer, use_raw, layer)
+            )
+        missing = [k for k in obs_keys if k not in self.obs_keys]
+        if len(missing) > 0:
+            raise ValueError(
+                "`.obs` columns not shared by the pool: {}".format(missing)
+            )
+
+    def quantiles(self, idx: Sequence[int], q: float) -> List[float]:
+        """
+        Compute a quantile of each gene in the workers.
+
+        Parameters
+        ----------
+        idx : Sequence[int]
+            column positions of the genes.
+        q : float
+            quantile to compute.
+
+        Returns
+        -------
+        List[float]
+            quantile of each gene, in the order of `idx`.
+        """
+        order = np.arange(len(idx))
+        batches = self._split(order)
+        res = self.map(_quantiles, [([idx[i] for i in b], q) for b in batches])
+        out = np.empty(len(idx))
+        for b, r in zip(batches, res):
+            out[b] = r
+        return out.tolist()
+
+    def aggregate(
+        self,
+        keys: Union[List[str], str],
+        genes: List[str],
+        stats: Sequence[str] = ("sum", "mean", "fraction", "var"),
+        expression_cutoff: float = 0.0,
+    ) -> Dict[str, pd.DataFrame]:
+        """
+        Run `aggregate` on the shared matrix with the genes split over the workers.
+
+        Parameters
+        ----------
+        keys : Union[List[str], str]
+            shared column(s) in `.obs` to group by.
+        genes : List[str]
+            genes to aggregate.
+        stats : Sequence[str], optional
+            statistics passed to `aggregate`.
+        expression_cutoff : float, optional
+            passed to `aggregate`.
+
+        Returns
+        -------
+        Dict[str, DataFrame]
+            groups x genes `DataFrame` for each requested statistic.
+        """
+        if type(keys) is not list:
+            keys = [keys]
+        self.check(self.use_raw, self.layer, keys)
+        res = self.map(
+            _aggregate,
+            [(keys, b, tuple(stats), expression_cutoff) for b in self._split(genes)],
+        )
+        return {
+            stat: pd.concat([r[stat] for r in res], axis=1)[genes] for stat in res[0]
+        }
+
+    def close(self) -> None:
+        """Shut down the workers and free the shared memory."""
+        self._executor.shutdown()
+        self._free()
+
+    def __enter__(self) -> "SharedPool":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
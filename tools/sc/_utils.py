@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# @Author: Kelvin
+# @Date:   2026-10-19 14:12:30
+# @Last Modified by:   Kelvin
+# @Last Modified time: 2026-10-19 14:12:30
+"""Helpers for the different matrix types that can back an `AnnData`."""
+import scipy.sparse
+
+import numpy as np
+
+from typing import Optional, Tuple
+
+
+def _is_dask(X) -> bool:
+    """
+    Check if a matrix is a dask array, without importing dask.
+
+    Parameters
+    ----------
+    X
+        matrix.
+
+    Returns
+    -------
+    bool
+        whether `X` is a dask array.
+    """
+    return type(X).__module__.split(".")[0] == "dask"
+
+
+def _dense(x) -> np.ndarray:
+    """
+    Convert a (computed) matrix to a dense array.
+
+    Parameters
+    ----------
+    x
+        sparse matrix or array.
+
+    Returns
+    -------
+    np.ndarray
+        dense array.
+    """
+    return x.toarray() if scipy.sparse.issparse(x) else np.asarray(x)
+
+
+def _get_matrix(adata: "AnnData", layer: Optional[str], use_raw: bool) -> Tuple:
+    """
+    Return the expression matrix and its var names.
+
+    Parameters
+    ----------
+    adata : AnnData
+        input `AnnData` object.
+    layer : Optional[str]
+        layer to use instead of `.X`.
+    use_raw : bool
+        whether to use `.raw`.
+
+    Returns
+    -------
+    Tuple
+        the matrix (in memory or backed) and its var names.
+    """
+    if use_raw and layer is not None:
+        raise ValueError("Cannot use `layer` and `use_raw` at the same time.")
+    if use_raw:
+        return adata.raw.X, adata.raw.var_names
+    if layer is not None:
+        return adata.layers[layer], adata.var_names
+    return adata.X, adata.var_names
+
+
+def _gene_column(X, idx: int) -> np.ndarray:
+    """
+    Extract one gene as a dense 1-D array.
+
+    For dask arrays only the chunks holding that column are computed.
+
+    Parameters
+    ----------
+    X
+        sparse, dense or dask matrix.
+    idx : int
+        column position.
+
+    Returns
+    -------
+    np.ndarray
+        expression of the gene in every cell.
+    """
+    col = X[:, [idx]]
+    if _is_dask(col):
+        col = col.compute()
+    return _dense(col).ravel()
+
+
+def _iter_values(X, size: int = 1 << 20):
+    """
+    Yield the stored values of a matrix in pieces.
+
+    Only the `.data` buffer of sparse matrices is visited, so implicit zeros
+    cost nothing. Dask arrays are computed one block at a time.
+
+    Parameters
+    ----------
+    X
+        sparse, dense or dask matrix.
+    size : int, optional
+        number of values per piece.
+
+    Yields
+    ------
+    np.ndarray
+        1-D array of values.
+    """
+    if _is_dask(X):
+        for block in X.to_delayed().ravel():
+            yield from _iter_values(block.compute(), size)
+    elif scipy.sparse.issparse(X):
+        data = X.data
+        for start in range(0, data.shape[0], size):
+            yield data[start : start + size]
+    else:
+        X = np.asarray(X)
+        rows = max(size // max(X.shape[1], 1), 1)
+        for start in range(0, X.shape[0], rows):
+            yield X[start : start + rows].ravel()
+
+
+def _row_sums(X, n: int = 100) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return sums and sums of `expm1` of the first `n` non-empty rows.
+
+    Parameters
+    ----------
+    X
+        sparse, dense or dask matrix.
+    n : int, optional
+        number of rows to look at.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        row sums and row sums after `expm1`.
+    """
+    rows = X[: min(n * 2, X.shape[0])]
+    if _is_dask(rows):
+        rows = rows.compute()
+    rows = _dense(rows).astype(np.float64)
+    rows = rows[(rows != 0).any(axis=1)][:n]
+    return rows.sum(axis=1), np.expm1(rows).sum(axis=1)
+
+
+def _is_constant(x: np.ndarray, rtol: float = 1e-3) -> bool:
+    """
+    Check if all values are (nearly) the same.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        values.
+    rtol : float, optional
+        tolerance relative to the mean.
+
+    Returns
+    -------
+    bool
+        whether the values are constant.
+    """
+    if x.shape[0] < 2:
+        return False
+    return bool(np.ptp(x) <= rtol * abs(np.mean(x)))
+
+
+def _detect_data_state(X, log1p: bool = False) -> str:
+    """
+    Detect whether a matrix holds counts, normalised, log1p or scaled data.
+
+    The values are scanned in pieces and the scan stops at the first piece
+    with a negative (scaled) or non-integer (not counts) value.
+    Non-integer data are told apart by their row sums: normalised rows sum to
+    the same total, log1p rows do so after `expm1`.
+
+    Parameters
+    ----------
+    X
+        sparse, dense or dask matrix.
+    log1p : bool, optional
+        whether the data are flagged as log1p transformed, e.g. `"log1p" in adata.uns`.
+
+    Returns
+    -------
+    str
+        one of `counts`, `normalized`, `log1p` or `scaled`.
+    """
+    for values in _iter_values(X):
+        if (values < 0).any():
+            return "scaled"
+        if (values != np.floor(values)).any():
+            break
+    else:
+        return "counts"
+    if log1p:
+        return "log1p"
+    sums, expm1_sums = _row_sums(X)
+    if _is_constant(expm1_sums):
+        return "log1p"
+    return "normalized"
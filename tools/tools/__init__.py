@@ -5,20 +5,28 @@
 # @Last Modified time: 2022-08-16 14:19:43
 """tools module."""
 from ._tools import (
+    add_alpha,
     alpha_code,
     cmp,
     get_hex,
     colorRampPalette,
+    map_colors,
     calc_centroid,
     closest_node,
+    nearest_nodes,
+    NodeIndex,
 )
 
 __all__ = [
     # miscellaneous
+    "add_alpha",
     "alpha_code",
     "cmp",
     "get_hex",
     "colorRampPalette",
+    "map_colors",
     "calc_centroid",
     "closest_node",
+    "nearest_nodes",
+    "NodeIndex",
 ]
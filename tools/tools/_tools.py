@@ -4,13 +4,26 @@
 # @Last Modified by:   Kelvin
 # @Last Modified time: 2022-08-16 14:19:25
 """Miscellaneous functions."""
+import matplotlib
 import numpy as np
 
 import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap
+from matplotlib.colors import Colormap, ListedColormap
 from numpy import ndarray
 
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple, Union
+
+# number of values mapped per block in `map_colors`
+BLOCK_SIZE = 1 << 16
+# number of query x node distances held at a time in `nearest_nodes`
+NN_BLOCK_SIZE = 1 << 24
+# two character hex code of every alpha byte
+ALPHA_HEX = np.array(["{:02X}".format(i) for i in range(256)])
+# upper case code point of each ASCII hex digit, 0 for other characters
+HEX_UPPER = np.zeros(128, dtype=np.uint32)
+HEX_UPPER[[ord(c) for c in "0123456789ABCDEFabcdef"]] = [
+    ord(c) for c in "0123456789ABCDEFABCDEF"
+]
 
 
 def cmp(palette: str = "viridis") -> ListedColormap:
@@ -220,6 +233,120 @@ def colorRampPalette(
     return newcmp
 
 
+def _color_lut(
+    palette: Union[str, Colormap], n: int = 256, alpha: Optional[float] = None
+) -> ndarray:
+    """
+    Tabulate a palette as uint8 RGBA colours.
+
+    Parameters
+    ----------
+    palette : Union[str, Colormap]
+        palette name accepted by `matplotlib.pyplot.get_cmap`, or a colormap
+        e.g. from `cmp` or `colorRampPalette`.
+    n : int, optional
+        number of colours.
+    alpha : Optional[float], optional
+        alpha level between 0 and 100 applied to all colours, as in
+        `alpha_code`. Kept from the palette if None.
+
+    Returns
+    -------
+    ndarray
+        (n + 1) x 4 array. The last row is the colour for missing values.
+    """
+    cmap = plt.get_cmap(palette) if isinstance(palette, str) else palette
+    lut = np.empty((n + 1, 4), dtype=np.uint8)
+    lut[:n] = cmap(np.linspace(0, 1, n), bytes=True)
+    lut[n] = cmap(np.nan, bytes=True)
+    if alpha is not None:
+        lut[:, 3] = _alpha_bytes(alpha, round=True)
+    return lut
+
+
+def map_colors(
+    values: ndarray,
+    vmin: Optional[float] = None,
+    vmax: Optional[float] = None,
+    palette: Union[str, Colormap] = "viridis",
+    n: int = 256,
+    alpha: Optional[float] = None,
+    as_hex: bool = False,
+    out: Optional[ndarray] = None,
+) -> ndarray:
+    """
+    Map values to colours through a precomputed lookup table.
+
+    Values are binned into `n` colours between `vmin` and `vmax` as matplotlib
+    does (clipped at both ends) and missing values get the palette's colour for bad values.
+    The values are processed in blocks, so memory use stays flat for millions
+    of cells.
+
+    Parameters
+    ----------
+    values : ndarray
+        values to colour e.g. expression of a gene in each cell.
+    vmin : Optional[float], optional
+        value mapped to the first colour e.g. from `vmin`. Minimum if None.
+    vmax : Optional[float], optional
+        value mapped to the last colour e.g. from `vmax`. Maximum if None.
+    palette : Union[str, Colormap], optional
+        palette name accepted by `matplotlib.pyplot.get_cmap`, or a colormap
+        e.g. from `cmp` or `colorRampPalette`.
+    n : int, optional
+        number of colours in the lookup table.
+    alpha : Optional[float], optional
+        alpha level between 0 and 100 applied to all colours, as in
+        `alpha_code`. Kept from the palette if None.
+    as_hex : bool, optional
+        whether to return `#RRGGBBAA` hex codes instead of RGBA bytes.
+    out : Optional[ndarray], optional
+        preallocated output, a uint8 array of shape `values.shape + (4,)`, or
+        a `<U9` array of shape `values.shape` if `as_hex` is True. Filled in place.
+
+    Returns
+    -------
+    ndarray
+        uint8 RGBA colours, or hex codes if `as_hex` is True.
+    """
+    values = np.asarray(values)
+    if vmin is None:
+        vmin = np.nanmin(values)
+    if vmax is None:
+        vmax = np.nanmax(values)
+    lut = _color_lut(palette, n=n, alpha=alpha)
+    if as_hex:
+        table = np.array(["#" + bytes(c).hex().upper() for c in lut], dtype="<U9")
+        if out is None:
+            out = np.empty(values.shape, dtype=table.dtype)
+        target = out.reshape(-1)
+    else:
+        # one uint32 per colour, so each lookup copies a whole RGBA pixel
+        table = lut.view(np.uint32).ravel()
+        if out is None:
+            out = np.empty(values.shape + (4,), dtype=np.uint8)
+        target = out.reshape(-1, 4).view(np.uint32).ravel()
+    if target.shape[0] != values.size or not np.shares_memory(target, out):
+        raise ValueError("`out` must be a contiguous array matching `values`.")
+
+    values = values.reshape(-1)
+    scale = n / (vmax - vmin) if vmax > vmin else 0.0
+    buf = np.empty(min(BLOCK_SIZE, values.shape[0]), dtype=np.float64)
+    idx = np.empty(buf.shape[0], dtype=np.intp)
+    for start in range(0, values.shape[0], BLOCK_SIZE):
+        block = values[start : start + BLOCK_SIZE]
+        m = block.shape[0]
+        b, i = buf[:m], idx[:m]
+        np.subtract(block, vmin, out=b)
+        np.multiply(b, scale, out=b)
+        np.clip(b, 0, n - 1, out=b)
+        nan = np.isnan(b)
+        b[nan] = n
+        i[:] = b
+        np.take(table, i, out=target[start : start + m])
+    return out
+
+
 def calc_centroid(points: ndarray) -> ndarray:
     """
     Calculate the centroid from a numpy 2 dimenional array.
@@ -247,136 +374,315 @@ def closest_node(query: ndarray, nodes: ndarray) -> int:
     Parameters
     ----------
     query : ndarray
-        x and y coordinate of query e.g. `array([2., 3.])`
+        coordinates of query e.g. `array([2., 3.])`
     nodes : ndarray
-        x and y coordinates of all nodes.
+        coordinates of all nodes. Only the first `len(query)` columns are used.
 
     Returns
     -------
     int
         index position of closest node in all nodes list.
     """
-    nodes = np.asarray(nodes[:, :2])
+    query = np.asarray(query).ravel()
+    nodes = np.asarray(nodes)[:, : query.shape[0]]
     deltas = nodes - query
     dist_2 = np.einsum("ij,ij->i", deltas, deltas)
     return np.argmin(dist_2)
 
 
-def alpha_code(alpha: int) -> str:
+def _top_k(dist_2: ndarray, k: int) -> ndarray:
+    """
+    Return the positions of the `k` smallest values of each row, in order.
+
+    Parameters
+    ----------
+    dist_2 : ndarray
+        two dimensional array of squared distances.
+    k : int
+        number of positions per row.
+
+    Returns
+    -------
+    ndarray
+        row-wise positions sorted by distance.
+    """
+    if k < dist_2.shape[1]:
+        idx = np.argpartition(dist_2, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.broadcast_to(np.arange(dist_2.shape[1]), dist_2.shape)
+    order = np.argsort(np.take_along_axis(dist_2, idx, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(idx, order, axis=1)
+
+
+def nearest_nodes(
+    queries: ndarray, nodes: ndarray, k: int = 1, block_size: int = NN_BLOCK_SIZE
+) -> Tuple[ndarray, ndarray]:
+    """
+    Find the `k` nearest nodes of every query by exact Euclidean distance.
+
+    Distances are computed for blocks of queries with one matrix product per
+    block, so memory is bounded by `block_size` distances at a time.
+
+    Parameters
+    ----------
+    queries : ndarray
+        queries x dimensions array, e.g. profiles in a PCA or latent space.
+        A single query can be given as a one dimensional array.
+    nodes : ndarray
+        nodes x dimensions array, in the same space as `queries`.
+    k : int, optional
+        number of neighbours per query.
+    block_size : int, optional
+        number of query x node distances computed at a time.
+
+    Returns
+    -------
+    Tuple[ndarray, ndarray]
+        queries x `k` arrays of node positions and distances, nearest first.
+    """
+    queries = np.atleast_2d(np.asarray(queries))
+    nodes = np.asarray(nodes)
+    if queries.shape[1] != nodes.shape[1]:
+        raise ValueError(
+            "`queries` have {} dimensions but `nodes` have {}.".format(
+                queries.shape[1], nodes.shape[1]
+            )
+        )
+    k = min(k, nodes.shape[0])
+    dtype = np.result_type(queries.dtype, nodes.dtype, np.float32)
+    queries, nodes = queries.astype(dtype, copy=False), nodes.astype(dtype, copy=False)
+    node_norms = np.einsum("ij,ij->i", nodes, nodes)
+    indices = np.empty((queries.shape[0], k), dtype=np.int64)
+    distances = np.empty((queries.shape[0], k), dtype=dtype)
+    step = max(block_size // max(nodes.shape[0], 1), 1)
+    for start in range(0, queries.shape[0], step):
+        block = queries[start : start + step]
+        # |q - n|^2 = |q|^2 - 2 q.n + |n|^2, with q.n as one GEMM
+        dist_2 = block @ nodes.T
+        dist_2 *= -2
+        dist_2 += node_norms
+        dist_2 += np.einsum("ij,ij->i", block, block)[:, None]
+        np.maximum(dist_2, 0, out=dist_2)
+        idx = _top_k(dist_2, k)
+        indices[start : start + step] = idx
+        distances[start : start + step] = np.sqrt(
+            np.take_along_axis(dist_2, idx, axis=1)
+        )
+    return indices, distances
+
+
+class NodeIndex:
+    """
+    Approximate nearest node index for large sets of nodes (IVF).
+
+    The nodes are partitioned into `n_lists` k-means clusters. A query is only
+    compared with the nodes of the `n_probe` clusters whose centroids are
+    nearest to it, so more probes trade speed for recall. With `n_probe` equal
+    to `n_lists` the search is exact.
+
+    Parameters
+    ----------
+    nodes : ndarray
+        nodes x dimensions array, e.g. cells in a PCA or latent space.
+    n_lists : Optional[int], optional
+        number of clusters. The square root of the number of nodes if None.
+    n_iter : int, optional
+        number of k-means iterations.
+    seed : int, optional
+        random seed for the k-means initialisation.
+
+    Examples
+    --------
+    >>> index = NodeIndex(adata.obsm["X_pca"])
+    >>> idx, dist = index.query(query.obsm["X_pca"], k=10, n_probe=8)
+    """
+
+    def __init__(
+        self,
+        nodes: ndarray,
+        n_lists: Optional[int] = None,
+        n_iter: int = 10,
+        seed: int = 0,
+    ):
+        nodes = np.asarray(nodes)
+        dtype = np.result_type(nodes.dtype, np.float32)
+        self.nodes = nodes.astype(dtype, copy=False)
+        n = self.nodes.shape[0]
+        if n_lists is None:
+            n_lists = int(np.sqrt(n))
+        n_lists = min(max(n_lists, 1), n)
+        rng = np.random.default_rng(seed)
+        # k-means on a sample is enough to place the centroids
+        sample = self.nodes[rng.choice(n, min(n, 64 * n_lists), replace=False)]
+        centroids = sample[rng.choice(sample.shape[0], n_lists, replace=False)]
+        for _ in range(n_iter):
+            labels = nearest_nodes(sample, centroids)[0][:, 0]
+            counts = np.bincount(labels, minlength=n_lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            # empty clusters keep their centroid
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+        labels = nearest_nodes(self.nodes, centroids)[0][:, 0]
+        self.centroids = centroids
+        # node positions grouped by cluster, with the bounds of each cluster
+        self._order = np.argsort(labels, kind="stable")
+        self._bounds = np.concatenate(
+            [[0], np.cumsum(np.bincount(labels, minlength=n_lists))]
+        )
+
+    @property
+    def n_lists(self) -> int:
+        """Number of clusters."""
+        return self.centroids.shape[0]
+
+    def query(
+        self, queries: ndarray, k: int = 1, n_probe: int = 8
+    ) -> Tuple[ndarray, ndarray]:
+        """
+        Find the approximate `k` nearest nodes of every query.
+
+        Parameters
+        ----------
+        queries : ndarray
+            queries x dimensions array. A single query can be given as a one
+            dimensional array.
+        k : int, optional
+            number of neighbours per query.
+        n_probe : int, optional
+            number of clusters searched per query.
+
+        Returns
+        -------
+        Tuple[ndarray, ndarray]
+            queries x `k` arrays of node positions and distances, nearest
+            first. Positions are -1 and distances inf where fewer than `k`
+            nodes were searched.
+        """
+        queries = np.atleast_2d(np.asarray(queries)).astype(
+            self.nodes.dtype, copy=False
+        )
+        n_probe = min(n_probe, self.n_lists)
+        probes = nearest_nodes(queries, self.centroids, k=n_probe)[0]
+        indices = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        distances = np.full((queries.shape[0], k), np.inf, dtype=self.nodes.dtype)
+        # one distance block per cluster, against the queries probing it
+        for c in range(self.n_lists):
+            rows = np.flatnonzero((probes == c).any(axis=1))
+            members = self._order[self._bounds[c] : self._bounds[c + 1]]
+            if rows.shape[0] == 0 or members.shape[0] == 0:
+                continue
+            idx, dist = nearest_nodes(queries[rows], self.nodes[members], k=k)
+            # merge with the best nodes found so far
+            idx = np.concatenate([indices[rows], members[idx]], axis=1)
+            dist = np.concatenate([distances[rows], dist], axis=1)
+            best = _top_k(dist, k)
+            indices[rows] = np.take_along_axis(idx, best, axis=1)
+            distances[rows] = np.take_along_axis(dist, best, axis=1)
+        return indices, distances
+
+
+def _alpha_bytes(alpha: ndarray, round: bool = False) -> ndarray:
+    """
+    Convert alpha levels in percent to bytes.
+
+    Parameters
+    ----------
+    alpha : ndarray
+        alpha levels between 0 and 100.
+    round : bool, optional
+        whether to round levels that are not whole percentages instead of
+        raising an error.
+
+    Returns
+    -------
+    ndarray
+        uint8 alpha bytes, `floor(alpha * 2.55 + 0.5)`.
+    """
+    alpha = np.asarray(alpha)
+    if alpha.dtype.kind not in "iuf":
+        raise ValueError("`alpha` must be numeric.")
+    if not round and alpha.dtype.kind == "f" and not np.all(alpha == np.floor(alpha)):
+        raise ValueError("`alpha` must be whole percentages unless `round=True`.")
+    if np.any(~((alpha >= 0) & (alpha <= 100))):
+        raise ValueError("`alpha` must be between 0 and 100.")
+    # 2.55 = 51 / 20, exact for whole percentages unlike alpha * 2.55
+    return np.floor((alpha * 51 + 10) / 20).astype(np.uint8)
+
+
+def alpha_code(alpha: Union[int, float, ndarray], round: bool = False):
     """
     Return the hex code for alpha transparency
 
     Parameters
     ----------
-    alpha : int
-        alpha level to convert.
+    alpha : Union[int, float, ndarray]
+        alpha level(s) to convert, between 0 and 100.
+    round : bool, optional
+        whether to round levels that are not whole percentages to the nearest
+        code instead of raising an error.
+
+    Returns
+    -------
+    str or ndarray
+        hex code for alpha transparency e.g. `"80"` for 50, or an array of
+        codes if `alpha` is an array.
+    """
+    codes = ALPHA_HEX[_alpha_bytes(alpha, round=round)]
+    return str(codes) if codes.ndim == 0 else codes
+
+
+def add_alpha(
+    colors: Union[str, List[str], ndarray],
+    alpha: Union[int, float, ndarray],
+    round: bool = False,
+):
+    """
+    Append alpha transparency to hex colours, e.g. from `get_hex`.
+
+    Colours and alpha levels are broadcast against each other, so one colour
+    per cell with one alpha level, or a palette indexed per cell with alpha
+    levels per cell, are encoded in one pass.
+
+    Parameters
+    ----------
+    colors : Union[str, List[str], ndarray]
+        `#RRGGBB` colour(s), in either case.
+    alpha : Union[int, float, ndarray]
+        alpha level(s) between 0 and 100.
+    round : bool, optional
+        whether to round levels that are not whole percentages to the nearest
+        code instead of raising an error.
 
     Returns
     -------
-    str
-        hex code for alpha transparency.
+    str or ndarray
+        `#RRGGBBAA` colour(s) in upper case.
     """
-    hex_dict = {
-        100: "FF",
-        99: "FC",
-        98: "FA",
-        97: "F7",
-        96: "F5",
-        95: "F2",
-        94: "F0",
-        93: "ED",
-        92: "EB",
-        91: "E8",
-        90: "E6",
-        89: "E3",
-        88: "E0",
-        87: "DE",
-        86: "DB",
-        85: "D9",
-        84: "D6",
-        83: "D4",
-        82: "D1",
-        81: "CF",
-        80: "CC",
-        79: "C9",
-        78: "C7",
-        77: "C4",
-        76: "C2",
-        75: "BF",
-        74: "BD",
-        73: "BA",
-        72: "B8",
-        71: "B5",
-        70: "B3",
-        69: "B0",
-        68: "AD",
-        67: "AB",
-        66: "A8",
-        65: "A6",
-        64: "A3",
-        63: "A1",
-        62: "9E",
-        61: "9C",
-        60: "99",
-        59: "96",
-        58: "94",
-        57: "91",
-        56: "8F",
-        55: "8C",
-        54: "8A",
-        53: "87",
-        52: "85",
-        51: "82",
-        50: "80",
-        49: "7D",
-        48: "7A",
-        47: "78",
-        46: "75",
-        45: "73",
-        44: "70",
-        43: "6E",
-        42: "6B",
-        41: "69",
-        40: "66",
-        39: "63",
-        38: "61",
-        37: "5E",
-        36: "5C",
-        35: "59",
-        34: "57",
-        33: "54",
-        32: "52",
-        31: "4F",
-        30: "4D",
-        29: "4A",
-        28: "47",
-        27: "45",
-        26: "42",
-        25: "40",
-        24: "3D",
-        23: "3B",
-        22: "38",
-        21: "36",
-        20: "33",
-        19: "30",
-        18: "2E",
-        17: "2B",
-        16: "29",
-        15: "26",
-        14: "24",
-        13: "21",
-        12: "1F",
-        11: "1C",
-        10: "1A",
-        9: "17",
-        8: "14",
-        7: "12",
-        6: "0F",
-        5: "0D",
-        4: "0A",
-        3: "08",
-        2: "05",
-        1: "03",
-        0: "00",
-    }
-    return hex_dict[alpha]
+    colors = np.asarray(colors)
+    width = colors.dtype.itemsize // 4 if colors.dtype.kind == "U" else 0
+    if width < 7:
+        raise ValueError("`colors` must be '#RRGGBB' hex codes.")
+    codes = _alpha_bytes(alpha, round=round)
+    points = (
+        np.ascontiguousarray(colors)
+        .reshape(-1)
+        .view(np.uint32)
+        .reshape(colors.shape + (width,))
+    )
+    # upper case hex digits, 0 for anything else
+    digits = HEX_UPPER[np.minimum(points[..., 1:7], HEX_UPPER.shape[0] - 1)]
+    if (
+        np.any(points[..., 0] != ord("#"))
+        or np.any(points[..., 7:] != 0)
+        or np.any(digits == 0)
+    ):
+        raise ValueError("`colors` must be '#RRGGBB' hex codes.")
+    # assemble the strings as code points, 7 from the colour and 2 from the table
+    shape = np.broadcast_shapes(colors.shape, codes.shape)
+    out = np.empty(shape, dtype="<U9")
+    chars = out.reshape(-1).view(np.uint32).reshape(shape + (9,))
+    chars[..., 0] = ord("#")
+    chars[..., 1:7] = digits
+    chars[..., 7:] = ALPHA_HEX.view(np.uint32).reshape(-1, 2)[codes]
+    return str(out) if out.ndim == 0 else out